@@ -54,5 +54,14 @@ DEFAULT_CONFIG = {
     "enforce_app_focus": False,
     "target_app_name": "",
     "lang": "en",
-    "theme": "darkly"
+    "theme": "darkly",
+    "chord_window_ms": 30,
+    "tap_hold_term_ms": 200,
+    "sequence_timeout_ms": 1000,
+    "autofire_rate_hz": 20,
+    "repeat_delay_ms": 500,
+    "repeat_rate_hz": 30,
+    "debounce_ms": 0,
+    "debounce_keys": [],
+    "snippets": {}
 }
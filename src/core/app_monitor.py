@@ -48,6 +48,7 @@ class AppMonitor:
         self.target_app_name = ""
         self.enforce_app_focus = True
         self.target_app_is_active = False
+        self._focus_listeners: List[Callable[[bool], None]] = []
         
         # Cache
         self._cache = {
@@ -409,9 +410,24 @@ class AppMonitor:
             return ""
     
     def update_status(self) -> bool:
-        self.target_app_is_active = self.is_target_app_active()
+        self._set_target_active(self.is_target_app_active())
         return self.target_app_is_active
     
+    def add_focus_listener(self, listener: Callable[[bool], None]):
+        """Registers a callback for target-app focus changes (receives the new state)"""
+        self._focus_listeners.append(listener)
+    
+    def _set_target_active(self, active: bool):
+        """Updates the focus state and notifies the listeners if it changed"""
+        if active == self.target_app_is_active:
+            return
+        self.target_app_is_active = active
+        for listener in self._focus_listeners:
+            try:
+                listener(active)
+            except Exception as e:
+                logger.error(f"Focus listener failed: {e}", exc_info=True)
+    
     # -------------------------------------------------------------------------
     # WINDOW SCANNING
     # -------------------------------------------------------------------------
@@ -716,7 +732,7 @@ class AppMonitor:
             if not is_event_monitoring_available(): return False
             
             def on_window_change(window_title: str):
-                self.target_app_is_active = self.target_app_name.lower() in window_title.lower()
+                self._set_target_active(self.target_app_name.lower() in window_title.lower())
                 if callback: callback(self.target_app_is_active)
             
             self.event_monitor = WindowEventMonitor(on_window_change)
@@ -0,0 +1,165 @@
+"""
+Chord rules ('j+k' pressed together -> output)
+Timing-window engine layered in front of the compiled dispatch callback
+"""
+
+import threading
+from typing import Callable, Dict, FrozenSet, List, Optional, Set
+
+from .ruleset import SCAN_CODE_SLOTS
+from .scheduler import Scheduler, TimerHandle
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+DEFAULT_CHORD_WINDOW_MS = 30
+
+
+class ChordEngine:
+    """
+    Hook-callback layer for chord rules.
+
+    A key press that can start a chord is held back (blocked) for the chord
+    window. If the keys pressed within the window complete a chord, its
+    handler fires and the original keys are swallowed until released;
+    otherwise the held keys are flushed, in order, through the inner
+    dispatch (their own rules) and re-injected if nothing claims them. The
+    window is measured with the events' timestamps; the scheduler only
+    flushes a buffer nobody completed.
+
+    'callback' is the hook callback. Keys that cannot start a chord go
+    straight to the inner dispatch when nothing is buffered: one call and
+    one table index on top of it, no lock, no timer (see
+    KeyHandler.benchmark_dispatch). While keys are held back, 'route_all'
+    asks the input backend for every key, so a key typed after them is
+    never delivered before them.
+    """
+
+    def __init__(self, chords: Dict[FrozenSet[int], Callable[[bool], bool]],
+                 chord_keys: bytearray, prefixes: Set[FrozenSet[int]],
+                 dispatch: Callable, replay: Callable[[int, int], None],
+                 route_all: Callable[[bool], None],
+                 monitor, scheduler: Scheduler, window_ms: float, key_down: str):
+        self.chords = chords
+        self.chord_keys = chord_keys
+        self.prefixes = prefixes
+        self.dispatch = dispatch
+        self.replay = replay
+        self.route_all = route_all
+        self.monitor = monitor
+        self.scheduler = scheduler
+        self.window_ms = window_ms
+        self.key_down = key_down
+
+        self._lock = threading.Lock()
+        self._buffer: List = []                 # Held-back key-down events
+        self._codes: FrozenSet[int] = frozenset()
+        self._timer: Optional[TimerHandle] = None
+        # Keys of the chord that fired, swallowed until released; the
+        # first release ends the chord's output
+        self._active_codes: Set[int] = set()
+        self._active_handler: Optional[Callable[[bool], bool]] = None
+
+        self.callback = self._make_callback()
+
+    def _make_callback(self):
+        """The hook callback: a closure, so the idle check reads locals
+        only (the buffer and active set are mutated in place, never
+        rebound)."""
+        buffer, active_codes = self._buffer, self._active_codes
+        chord_keys, key_down = self.chord_keys, self.key_down
+        dispatch, lock, handle = self.dispatch, self._lock, self._handle
+
+        def callback(e):
+            if not buffer and not active_codes:
+                scan_code = e.scan_code
+                if (not 0 <= scan_code < SCAN_CODE_SLOTS or not chord_keys[scan_code]
+                        or e.event_type != key_down):
+                    return dispatch(e)
+            with lock:
+                return handle(e)
+        return callback
+
+    def _handle(self, e) -> bool:
+        scan_code = e.scan_code
+        is_down = e.event_type == self.key_down
+
+        if scan_code in self._active_codes:
+            if not is_down:
+                self._active_codes.discard(scan_code)
+                handler, self._active_handler = self._active_handler, None
+                if handler is not None:
+                    handler(False)
+            return False
+
+        if self._buffer:
+            if is_down and scan_code in self._codes:
+                return False  # Auto-repeat while waiting
+            if is_down and (e.time - self._buffer[0].time) * 1000 <= self.window_ms:
+                candidate = self._codes | {scan_code}
+                handler = self.chords.get(candidate)
+                if handler is not None:
+                    self._cancel_timer()
+                    self._buffer.clear()
+                    self._codes = frozenset()
+                    self.route_all(False)
+                    self._active_codes.update(candidate)
+                    self._active_handler = handler
+                    handler(True)
+                    return False
+                if candidate in self.prefixes:
+                    self._buffer.append(e)
+                    self._codes = candidate
+                    return False
+            self._flush()
+
+        if (is_down and 0 <= scan_code < SCAN_CODE_SLOTS and self.chord_keys[scan_code]
+                and self.monitor.target_app_is_active):
+            self.route_all(True)
+            self._buffer.append(e)
+            self._codes = frozenset((scan_code,))
+            timer = None
+
+            def expire():
+                with self._lock:
+                    if self._timer is timer:
+                        self._flush()
+
+            timer = self._timer = self.scheduler.call_later(
+                int(self.window_ms * 1_000_000), expire)
+            return False
+
+        return self.dispatch(e)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush(self):
+        """Plays the held-back presses, in order, as if no chord existed."""
+        self._cancel_timer()
+        events = self._buffer[:]
+        self._buffer.clear()
+        self._codes = frozenset()
+        if events:
+            self.route_all(False)
+        for event in events:
+            try:
+                if self.dispatch(event) is not False:
+                    self.replay(event.scan_code, 1)
+            except Exception as exc:
+                logger.error(f"Error flushing chord key: {exc}", exc_info=True)
+
+    def reset(self):
+        """Flushes held-back keys and forgets a fired chord (focus change,
+        stop): the releases of its keys may never reach the hook."""
+        with self._lock:
+            self._flush()
+            self._active_codes.clear()
+            self._active_handler = None
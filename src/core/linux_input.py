@@ -0,0 +1,773 @@
+"""
+Low-level evdev/uinput helpers (Linux-only)
+Used by the Linux patches of the 'keyboard' library in key_handler
+"""
+
+import ctypes
+import fcntl
+import os
+import select
+import struct
+import threading
+import time
+from array import array
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# struct input_event: struct timeval (long, long), __u16 type, __u16 code,
+# __s32 value. Native alignment, like the kernel ABI.
+EVENT_STRUCT = struct.Struct('llHHi')
+EVENT_SIZE = EVENT_STRUCT.size
+
+# Taken from include/uapi/linux/input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_MSC = 0x04
+EV_CNT = 0x20
+SYN_REPORT = 0
+
+KEY_CNT = 0x300
+BTN_MISC = 0x100
+
+# Codes that make a device a keyboard for the kernel's 'kbd' handler (and
+# so for /proc/bus/input/devices, which the library enumerates at startup)
+KEYBOARD_KEYS = range(1, BTN_MISC)
+
+# ioctls from include/uapi/linux/input.h
+EVIOCGRAB = 0x40044590
+EVIOCSMASK = 0x40104593  # _IOW('E', 0x93, struct input_mask)
+_KEY_BITS_SIZE = KEY_CNT // 8
+EVIOCGBIT_KEY = (2 << 30) | (_KEY_BITS_SIZE << 16) | (ord('E') << 8) | (0x20 + EV_KEY)
+EVIOCGKEY = (2 << 30) | (_KEY_BITS_SIZE << 16) | (ord('E') << 8) | 0x18
+
+def query_key_capabilities(fd: int) -> Optional[bytes]:
+    """
+    Key codes a device can emit (EVIOCGBIT(EV_KEY)), as a bitmap indexed
+    by scan code. None if the device cannot be queried.
+    """
+    bits = bytearray(_KEY_BITS_SIZE)
+    try:
+        fcntl.ioctl(fd, EVIOCGBIT_KEY, bits, True)
+    except OSError as e:
+        logger.debug(f"EVIOCGBIT not available on fd {fd}: {e}")
+        return None
+    return bytes(bits)
+
+
+def query_held_keys(fd: int) -> List[int]:
+    """
+    Key codes currently down on a device (EVIOCGKEY), as the kernel sees
+    them. Empty if the device cannot be queried.
+    """
+    bits = bytearray(_KEY_BITS_SIZE)
+    try:
+        fcntl.ioctl(fd, EVIOCGKEY, bits, True)
+    except OSError:
+        return []
+    return [index * 8 + bit for index, byte in enumerate(bits) if byte
+            for bit in range(8) if byte >> bit & 1]
+
+
+def can_emit_any(capabilities: Optional[bytes], scan_codes) -> bool:
+    """True if a capability bitmap has any of 'scan_codes' (or is unknown)."""
+    if capabilities is None:
+        return bool(scan_codes)
+    return any(capabilities[code >> 3] >> (code & 7) & 1
+               for code in scan_codes if code < KEY_CNT)
+
+
+def set_grab(fd: int, grab: bool) -> bool:
+    """EVIOCGRAB on/off: while grabbed, nobody else receives the events."""
+    try:
+        fcntl.ioctl(fd, EVIOCGRAB, 1 if grab else 0)
+        return True
+    except OSError as e:
+        logger.warning(f"EVIOCGRAB({int(grab)}) failed on fd {fd}: {e}")
+        return False
+
+
+# struct input_mask: __u32 type, __u32 codes_size, __u64 codes_ptr
+_INPUT_MASK_STRUCT = struct.Struct('IIQ')
+
+
+def set_event_type_mask(fd: int, event_types) -> bool:
+    """
+    Installs an EVIOCSMASK so the kernel only queues the given event types
+    for this client (EV_SYN is never filtered; packets left empty, e.g. a
+    lone MSC_SCAN or LED report, are dropped without waking the reader).
+    Returns False on kernels without EVIOCSMASK (< 4.4).
+    """
+    bitmap = bytearray((EV_CNT + 7) // 8)
+    for event_type in event_types:
+        bitmap[event_type // 8] |= 1 << (event_type % 8)
+    codes = (ctypes.c_ubyte * len(bitmap)).from_buffer(bitmap)
+    # For type EV_SYN the mask is over event types, not codes (see evdev.c)
+    request = _INPUT_MASK_STRUCT.pack(EV_SYN, len(bitmap), ctypes.addressof(codes))
+    try:
+        fcntl.ioctl(fd, EVIOCSMASK, request)
+        return True
+    except OSError as e:
+        logger.debug(f"EVIOCSMASK not available on fd {fd}: {e}")
+        return False
+    finally:
+        del codes
+
+
+class UinputWriter:
+    """
+    Batched writer for a uinput device.
+
+    Every input_event of one logical action (a passthrough key, the press
+    or release of a multi-key replacement) is packed into a preallocated
+    buffer, followed by a single SYN_REPORT, and handed to the kernel with
+    one os.write. The kernel stamps injected events itself, so the
+    timestamps are left at zero instead of calling time() per event.
+
+    Thread-safe: the hook thread and timer threads may inject concurrently.
+    """
+
+    def __init__(self, fd: int, capacity: int = 16):
+        self._fd = fd
+        self._lock = threading.Lock()
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        """(Re)allocates room for 'capacity' events plus the SYN_REPORT."""
+        self._capacity = capacity
+        self._buffer = bytearray(EVENT_SIZE * (capacity + 1))
+        self._view = memoryview(self._buffer)
+
+    def write(self, steps: Sequence[Tuple[int, int]], type_: int = EV_KEY):
+        """Writes (code, value) steps as one action with a single syscall."""
+        with self._lock:
+            count = len(steps)
+            if count > self._capacity:
+                self._allocate(count)
+            pack_into, buffer = EVENT_STRUCT.pack_into, self._buffer
+            offset = 0
+            for code, value in steps:
+                pack_into(buffer, offset, 0, 0, type_, code, value)
+                offset += EVENT_SIZE
+            pack_into(buffer, offset, 0, 0, EV_SYN, SYN_REPORT, 0)
+            os.write(self._fd, self._view[:offset + EVENT_SIZE])
+
+    def write_key(self, code: int, value: int):
+        """Fast path for a single key event (passthrough)."""
+        with self._lock:
+            buffer = self._buffer
+            EVENT_STRUCT.pack_into(buffer, 0, 0, 0, EV_KEY, code, value)
+            EVENT_STRUCT.pack_into(buffer, EVENT_SIZE, 0, 0, EV_SYN, SYN_REPORT, 0)
+            os.write(self._fd, self._view[:2 * EVENT_SIZE])
+
+
+# uinput ioctl (include/uapi/linux/uinput.h): sysfs name of the created
+# device, e.g. "input27". _IOC(_IOC_READ, 'U', 44, len)
+_SYSNAME_SIZE = 64
+UI_GET_SYSNAME = (2 << 30) | (_SYSNAME_SIZE << 16) | (ord('U') << 8) | 44
+
+
+def uinput_event_nodes(uinput_fd: int) -> Set[str]:
+    """
+    /dev/input/event* nodes that belong to a uinput device we created, so
+    our own output is never picked up as a keyboard. Empty if unknown.
+    """
+    name = bytearray(_SYSNAME_SIZE)
+    try:
+        fcntl.ioctl(uinput_fd, UI_GET_SYSNAME, name, True)
+    except OSError as e:
+        logger.debug(f"UI_GET_SYSNAME not available: {e}")
+        return set()
+    sysname = name.split(b'\0', 1)[0].decode()
+    try:
+        entries = os.listdir(f"/sys/devices/virtual/input/{sysname}")
+    except OSError:
+        return set()
+    return {f"/dev/input/{entry}" for entry in entries if entry.startswith("event")}
+
+
+# inotify (sys/inotify.h); not in the standard library, so through libc
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# struct inotify_event: int wd, __u32 mask, __u32 cookie, __u32 len, name[len]
+_INOTIFY_EVENT_STRUCT = struct.Struct('iIII')
+
+
+class DeviceNodeWatcher:
+    """
+    Watches a directory (/dev/input) for event* nodes being created or
+    removed. IN_ATTRIB is reported as an addition too: udev creates the
+    node first and fixes its group/permissions right after, so a node that
+    could not be opened on IN_CREATE is retried then.
+
+    The directory is a parameter so the watcher (and everything built on
+    it) can be exercised with fake nodes in a temporary directory.
+    """
+
+    def __init__(self, directory: str = "/dev/input"):
+        self.directory = directory
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch = libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), IN_CREATE | IN_DELETE | IN_ATTRIB)
+        if watch < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {directory}")
+
+    def read_changes(self) -> List[Tuple[str, bool]]:
+        """Pending (path, added) changes for event* nodes, in order."""
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _INOTIFY_EVENT_STRUCT.size <= len(data):
+                _, mask, _, length = _INOTIFY_EVENT_STRUCT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT_STRUCT.size
+                name = data[offset:offset + length].split(b'\0', 1)[0].decode()
+                offset += length
+                if name.startswith("event"):
+                    changes.append((os.path.join(self.directory, name), not mask & IN_DELETE))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+# (seconds, microseconds, type, code, value, device path)
+RawEvent = Tuple[int, int, int, int, int, str]
+
+_by_timestamp = itemgetter(0, 1)
+
+
+_NEVER_US = 1 << 62
+
+
+class ChatterFilter:
+    """
+    Key chatter filter over batches of RawEvents, on the kernel's own
+    timestamps. 'windows_us' has one window per key code (0 = not
+    filtered). Every transition of a key that comes within its window of
+    the key's previous one is dropped, either way: press chatter and
+    release chatter alike. Once a key has been quiet for a window, its
+    state is passed on if it differs from the last one passed (a short tap
+    inside the window, a bounce that ended the other way), so no key is
+    left stuck or lost.
+
+    Per device: the time of each key's last transition, the state passed
+    on and the state last reported, in fixed-size arrays allocated once.
+    Keys waiting to settle are kept apart with their deadline, so the
+    reader knows when to wake up (next_deadline). Used by one thread; a
+    change of settings is a new filter, not a change to this one.
+    """
+
+    def __init__(self, windows_us: Sequence[int]):
+        self.windows = array('q', windows_us)
+        self._state: Dict[str, Tuple[array, bytearray, bytearray]] = {}
+        self._unsettled: Dict[Tuple[str, int], int] = {}
+        self.dropped = 0
+
+    def next_deadline(self) -> Optional[float]:
+        """Time (epoch seconds) the first waiting key settles, or None."""
+        if not self._unsettled:
+            return None
+        return min(self._unsettled.values()) / 1e6
+
+    def filter(self, events: List[RawEvent], now_us: int) -> List[RawEvent]:
+        """The events to pass on, with the keys settled by 'now_us' (epoch
+        microseconds) added at their deadline."""
+        windows = self.windows
+        slots = len(windows)
+        state_by_device = self._state
+        unsettled = self._unsettled
+        kept = []
+        for event in events:
+            seconds, microseconds, type_, code, value, device_id = event
+            if type_ != EV_KEY or code >= slots or not windows[code]:
+                kept.append(event)
+                continue
+            state = state_by_device.get(device_id)
+            if state is None:
+                # No previous transition: as if long before any window
+                state = state_by_device[device_id] = (
+                    array('q', [-_NEVER_US]) * slots, bytearray(slots), bytearray(slots))
+            changed, passed, reported = state
+            now = seconds * 1_000_000 + microseconds
+            deadline = unsettled.get((device_id, code))
+            if deadline is not None and now >= deadline:
+                self._settle(device_id, code, deadline, kept)
+            if value == 2:
+                # Repeats of a key passed on as released are chatter
+                if passed[code]:
+                    kept.append(event)
+                continue
+            reported[code] = value
+            if now - changed[code] < windows[code]:
+                changed[code] = now
+                self.dropped += 1
+                if value != passed[code]:
+                    unsettled[(device_id, code)] = now + windows[code]
+                else:
+                    unsettled.pop((device_id, code), None)
+                continue
+            changed[code] = now
+            passed[code] = value
+            kept.append(event)
+        if unsettled:
+            for (device_id, code), deadline in list(unsettled.items()):
+                if deadline <= now_us:
+                    self._settle(device_id, code, deadline, kept)
+        return kept
+
+    def _settle(self, device_id: str, code: int, deadline: int, kept: List[RawEvent]):
+        """Passes on the state a key settled in once its window closed."""
+        del self._unsettled[(device_id, code)]
+        _, passed, reported = self._state[device_id]
+        if reported[code] != passed[code]:
+            passed[code] = reported[code]
+            kept.append((deadline // 1_000_000, deadline % 1_000_000, EV_KEY,
+                         code, reported[code], device_id))
+
+
+class EvdevReader:
+    """
+    Reads every registered evdev device from a single epoll loop.
+
+    Replaces one blocking reader thread per /dev/input/event* (plus a queue
+    hop per event) with one thread that sleeps in epoll until any device
+    has data, drains everything that is ready and returns it ordered by
+    kernel timestamp, so the caller can dispatch straight to the handler.
+
+    Each device is read with readv into a preallocated buffer sized for
+    'batch' events and parsed in one pass with iter_unpack over a
+    memoryview: a burst (n-key rollover, macro pads, autorepeat) costs one
+    syscall and no per-event bytes objects.
+
+    Counters ('wakeups', 'reads', 'events', 'key_events') make the cost per
+    keystroke measurable; see stats().
+
+    Non-evdev descriptors (e.g. an inotify watch) can share the loop with
+    watch(): their callback runs on the reader thread when they are ready.
+    """
+
+    def __init__(self, on_device_lost: Optional[Callable[[int], None]] = None,
+                 batch: int = 64):
+        self._epoll = select.epoll()
+        self._paths: Dict[int, str] = {}
+        self._watches: Dict[int, Callable[[], None]] = {}
+        self._on_device_lost = on_device_lost
+        self._buffer = bytearray(EVENT_SIZE * batch)
+        self._view = memoryview(self._buffer)
+        self.wakeups = 0
+        self.reads = 0
+        self.events = 0
+        self.key_events = 0
+
+    def register(self, fd: int, path: str):
+        """Adds a device. The fd is switched to non-blocking mode."""
+        os.set_blocking(fd, False)
+        self._epoll.register(fd, select.EPOLLIN)
+        self._paths[fd] = path
+
+    def unregister(self, fd: int):
+        """Removes a device (no-op if it is not registered)."""
+        if self._paths.pop(fd, None) is None:
+            return
+        try:
+            self._epoll.unregister(fd)
+        except (OSError, ValueError):
+            pass
+
+    def watch(self, fd: int, callback: Callable[[], None]):
+        """Calls 'callback' (on the reader thread) whenever 'fd' is readable."""
+        self._watches[fd] = callback
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def _lost(self, fd: int):
+        """A device went away (unplugged, ENODEV): forget it."""
+        logger.info(f"Input device lost: {self._paths.get(fd)}")
+        self.unregister(fd)
+        if self._on_device_lost:
+            self._on_device_lost(fd)
+
+    def read_events(self, timeout: float = -1) -> List[RawEvent]:
+        """
+        Blocks until at least one device is readable (or 'timeout' seconds
+        pass) and returns every available event, oldest first.
+        """
+        events: List[RawEvent] = []
+        append = events.append
+        buffers = [self._buffer]
+        capacity = len(self._buffer)
+        view = self._view
+        iter_unpack = EVENT_STRUCT.iter_unpack
+        ready = self._epoll.poll(timeout)
+        self.wakeups += 1
+        for fd, mask in ready:
+            path = self._paths.get(fd)
+            if path is None:
+                callback = self._watches.get(fd)
+                if callback is not None:
+                    callback()
+                continue
+            if mask & (select.EPOLLERR | select.EPOLLHUP):
+                self._lost(fd)
+                continue
+            while True:
+                try:
+                    size = os.readv(fd, buffers)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self._lost(fd)
+                    break
+                self.reads += 1
+                # evdev only hands out whole events
+                size -= size % EVENT_SIZE
+                for event in iter_unpack(view[:size]):
+                    append(event + (path,))
+                    if event[2] == EV_KEY:
+                        self.key_events += 1
+                self.events += size // EVENT_SIZE
+                # A short read means the device is drained: skip the EAGAIN
+                if size < capacity:
+                    break
+        # Each device is already in order; merge them by kernel timestamp
+        if len(ready) > 1:
+            events.sort(key=_by_timestamp)
+        return events
+
+    def stats(self) -> Dict[str, float]:
+        """Read counters, plus reads and events per key event."""
+        keys = self.key_events or 1
+        return {
+            "wakeups": self.wakeups,
+            "reads": self.reads,
+            "events": self.events,
+            "key_events": self.key_events,
+            "reads_per_key": self.reads / keys,
+            "events_per_key": self.events / keys,
+        }
+
+    def close(self):
+        self._paths.clear()
+        self._watches.clear()
+        self._epoll.close()
+
+    @staticmethod
+    def benchmark(keys: int = 6, rounds: int = 2000, batch: int = 64) -> Dict[str, float]:
+        """
+        Replays a recorded n-key-rollover burst ('keys' presses, then their
+        releases; each as MSC_SCAN + EV_KEY + SYN_REPORT, like a USB
+        keyboard) through a pipe and reads it back three ways:
+
+        'single': one read() + unpack per event (the keyboard library's
+        EventDevice.read_event), every event type delivered;
+        'batched': EvdevReader (epoll + readv + iter_unpack), same burst;
+        'masked': EvdevReader with the burst EVIOCSMASK leaves (no EV_MSC).
+
+        Returns '<path>_ns_per_key' and '<path>_reads_per_key', best of 5.
+        """
+        MSC_SCAN = 4
+        full = bytearray()
+        masked = bytearray()
+        for value in (1, 0):
+            for code in range(30, 30 + keys):
+                scan = EVENT_STRUCT.pack(0, 0, EV_MSC, MSC_SCAN, 0x70004 + code)
+                press = EVENT_STRUCT.pack(0, 0, EV_KEY, code, value)
+                report = EVENT_STRUCT.pack(0, 0, EV_SYN, SYN_REPORT, 0)
+                full += scan + press + report
+                masked += press + report
+        key_events = 2 * keys
+        results: Dict[str, float] = {}
+
+        def single(burst):
+            read_fd, write_fd = os.pipe()
+            count = len(burst) // EVENT_SIZE
+            unpack = EVENT_STRUCT.unpack
+            best = None
+            try:
+                for _ in range(5):
+                    elapsed = 0
+                    for _ in range(rounds):
+                        os.write(write_fd, burst)
+                        start = time.perf_counter_ns()
+                        for _ in range(count):
+                            unpack(os.read(read_fd, EVENT_SIZE))
+                        elapsed += time.perf_counter_ns() - start
+                    best = elapsed if best is None else min(best, elapsed)
+            finally:
+                os.close(read_fd)
+                os.close(write_fd)
+            return best, count
+
+        def batched(burst):
+            read_fd, write_fd = os.pipe()
+            reader = EvdevReader(batch=batch)
+            reader.register(read_fd, "benchmark")
+            best = None
+            try:
+                for _ in range(5):
+                    elapsed = 0
+                    reader.reads = 0
+                    for _ in range(rounds):
+                        os.write(write_fd, burst)
+                        start = time.perf_counter_ns()
+                        reader.read_events(0)
+                        elapsed += time.perf_counter_ns() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                reads = reader.reads / rounds
+            finally:
+                reader.close()
+                os.close(read_fd)
+                os.close(write_fd)
+            return best, reads
+
+        for label, run, burst in (('single', single, full), ('batched', batched, full),
+                                  ('masked', batched, masked)):
+            elapsed, reads = run(bytes(burst))
+            results[f'{label}_ns_per_key'] = round(elapsed / (rounds * key_events), 1)
+            results[f'{label}_reads_per_key'] = round(reads / key_events, 2)
+        return results
+
+
+class EpollAggregatedDevice:
+    """
+    Drop-in replacement for the keyboard library's AggregatedEventDevice
+    (see key_handler). The library starts one reader thread per device
+    feeding a Queue; here every device is registered in a single
+    EvdevReader (epoll) that the caller drains on its own thread. Devices
+    without access are skipped instead of parking a thread on them.
+
+    Devices are the library's EventDevice or anything alike: a 'path', an
+    'input_file' (None when it cannot be opened) and its '_input_file'.
+    'open_device' builds one for a hot-plugged path, and 'release_keys'
+    sends releases on the output when a device is ungrabbed.
+
+    Each device also gets an EVIOCSMASK for EV_KEY only: EV_MSC scan
+    events and LED reports were read just to be discarded, and
+    packets with nothing left in them no longer wake the reader.
+
+    Only devices that can emit a source key of an active rule (per
+    EVIOCGBIT) are grabbed and read; see update_grabs().
+
+    Keyboards plugged in (or removed) while running are picked up
+    from an inotify watch on 'watch_directory', drained by the same
+    reader loop: no restart of the hook is needed. Our own uinput
+    node is never read, whether listed at startup or plugged in.
+
+    Grabs change with focus too (see KeyHandler._sync_input_filter),
+    so both transitions take care of keys held across them: an
+    ungrab releases on uinput what we had pressed there, and a grab
+    waits until no key is down on the device, since the system saw
+    those presses and must also see their releases.
+    """
+
+    def __init__(self, devices, output=None, watch_directory: str = "/dev/input",
+                 open_device: Optional[Callable[[str], object]] = None,
+                 release_keys: Optional[Callable[[Tuple[Tuple[int, int], ...]], None]] = None):
+        self.devices = list(devices)
+        self.output = output or self.devices[0]
+        self._by_fd = {}
+        self._capabilities = {}
+        self._grabbed = set()
+        self._pending = {}
+        self._grab_lock = threading.Lock()
+        self._open_device = open_device
+        self._release_keys = release_keys
+        self._source_codes = None
+        self.reader = EvdevReader(on_device_lost=self._on_device_lost)
+        # Our own output must never be read back as input: the hook relies
+        # on it (see key_handler._injection_loops_back)
+        self._own_nodes = set()
+        for device in list(self.devices):
+            if self._is_own_node(device.path):
+                logger.debug(f"{device.path} is our own output, not read")
+                self.devices.remove(device)
+            else:
+                self._open(device)
+
+        self.watcher = None
+        if watch_directory and os.path.isdir(watch_directory):
+            try:
+                self.watcher = DeviceNodeWatcher(watch_directory)
+                self.reader.watch(self.watcher.fd, self._on_nodes_changed)
+            except OSError as e:
+                logger.warning(f"Keyboard hot-plug not available: {e}")
+        self.update_grabs(None)
+
+    def _is_own_node(self, path) -> bool:
+        """True if 'path' is an event node of our uinput output. Looked up
+        again for unknown paths: sysfs may list the node late."""
+        if path in self._own_nodes:
+            return True
+        output_file = getattr(self.output, '_output_file', None)
+        if output_file is None:
+            return False
+        self._own_nodes = uinput_event_nodes(output_file.fileno())
+        return path in self._own_nodes
+
+    def _open(self, device):
+        """Opens a device and registers it, without grabbing it.
+        Returns its fd, or None when it cannot be read."""
+        f = device.input_file
+        if f is None:
+            return None
+        fd = f.fileno()
+        self._by_fd[fd] = device
+        self._capabilities[fd] = query_key_capabilities(fd)
+        set_event_type_mask(fd, (EV_KEY,))
+        return fd
+
+    def _apply_grab(self, fd, device, source_codes):
+        wanted = (source_codes is None
+                  or can_emit_any(self._capabilities.get(fd), source_codes))
+        if wanted and fd not in self._grabbed and fd not in self._pending:
+            self.reader.register(fd, device.path)
+            if query_held_keys(fd):
+                # Read (not grabbed) until those keys come up; see
+                # _settle_pending
+                self._pending[fd] = device.path
+            else:
+                # A failed grab (another program holds it) still
+                # reads the device, as before
+                set_grab(fd, True)
+                self._grabbed.add(fd)
+        elif not wanted and (fd in self._grabbed or fd in self._pending):
+            self.reader.unregister(fd)
+            if self._pending.pop(fd, None) is None:
+                held = query_held_keys(fd)
+                set_grab(fd, False)
+                self._grabbed.discard(fd)
+                # Their releases now go straight to the system, so
+                # the copies we pressed on uinput would stay down
+                if held and self._release_keys is not None:
+                    self._release_keys(tuple((code, 0) for code in held))
+            logger.debug(f"{device.path} released to the kernel")
+
+    def _settle_pending(self, events):
+        """
+        Drops the events of devices waiting for a grab (the system
+        already got them) and grabs those that have no key down.
+        """
+        with self._grab_lock:
+            pending_paths = set(self._pending.values())
+            for fd in list(self._pending):
+                if not query_held_keys(fd):
+                    del self._pending[fd]
+                    set_grab(fd, True)
+                    self._grabbed.add(fd)
+        return [event for event in events if event[5] not in pending_paths]
+
+    def update_grabs(self, source_codes):
+        """
+        Grabs and reads the devices that can produce one of
+        'source_codes'; releases the rest back to the kernel.
+        None means every device (hook stopped, key capture, or rules
+        not resolved to scan codes).
+        """
+        with self._grab_lock:
+            self._source_codes = source_codes
+            for fd, device in list(self._by_fd.items()):
+                self._apply_grab(fd, device, source_codes)
+
+    def attach(self, path):
+        """
+        Adds a newly created event node if it is a keyboard (can emit
+        a key below BTN_MISC, like the kernel's 'kbd' handler) and
+        grabs it per the current rules. Returns True if attached.
+        """
+        with self._grab_lock:
+            if self._is_own_node(path) or any(
+                    device.path == path for device in self._by_fd.values()):
+                return False
+            if not os.access(path, os.R_OK):
+                # udev has not fixed the permissions yet: retried on
+                # the IN_ATTRIB that follows
+                return False
+            if self._open_device is None:
+                return False
+            device = self._open_device(path)
+            fd = self._open(device)
+            if fd is None:
+                return False
+            if not can_emit_any(self._capabilities[fd], KEYBOARD_KEYS):
+                self._close(fd)
+                return False
+            self.devices.append(device)
+            self._apply_grab(fd, device, self._source_codes)
+        logger.info(f"Keyboard connected: {path}")
+        return True
+
+    def detach(self, path):
+        """Drops a removed event node. Returns True if it was attached."""
+        with self._grab_lock:
+            for fd, device in list(self._by_fd.items()):
+                if device.path == path:
+                    self.reader.unregister(fd)
+                    self._close(fd)
+                    break
+            else:
+                return False
+        logger.info(f"Keyboard disconnected: {path}")
+        return True
+
+    def _on_nodes_changed(self):
+        for path, added in self.watcher.read_changes():
+            if added:
+                self.attach(path)
+            else:
+                self.detach(path)
+
+    def _close(self, fd):
+        self._grabbed.discard(fd)
+        self._pending.pop(fd, None)
+        self._capabilities.pop(fd, None)
+        device = self._by_fd.pop(fd, None)
+        if device is None:
+            return
+        if device in self.devices:
+            self.devices.remove(device)
+        if device._input_file is not None:
+            try:
+                device._input_file.close()
+            except Exception:
+                pass
+            device._input_file = None
+
+    def _on_device_lost(self, fd):
+        # Unplugged: the reader already dropped the fd (ENODEV)
+        self._close(fd)
+
+    def read_events(self, timeout=-1):
+        events = self.reader.read_events(timeout)
+        if self._pending:
+            events = self._settle_pending(events)
+        return events
+
+    def read_event(self):
+        # Compatibility with the library's single-event API
+        while True:
+            for sec, usec, type_, code, value, path in self.read_events():
+                return sec + usec / 1e6, type_, code, value, path
+
+    def write_event(self, type_, code, value):
+        self.output.write_event(type_, code, value)
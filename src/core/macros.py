@@ -0,0 +1,322 @@
+"""
+Macro rules (one key plays a scripted series of keys and delays)
+Compiled step frames played on the key engine's scheduler thread
+"""
+
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .ruleset import OutputAction
+from .scheduler import Scheduler, TimerHandle
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+DEFAULT_AUTOFIRE_RATE_HZ = 20
+MAX_AUTOFIRE_RATE_HZ = 500
+
+# Auto-repeat generated for rules with the 'generate' repeat policy
+DEFAULT_REPEAT_DELAY_MS = 500
+DEFAULT_REPEAT_RATE_HZ = 30
+
+# Upper bounds for the counts in a macro, so a typo cannot queue millions
+# of key events
+MAX_STEP_COUNT = 1000
+MAX_REPEAT_COUNT = 10000
+
+_DELAY = re.compile(r'(\d+(?:\.\d+)?)\s*ms')
+_COUNT = re.compile(r'(.+?)\s*\*\s*(\d+)')
+
+
+class RepeatStats:
+    """
+    Intervals between the starts of consecutive loops of repeating macros
+    (an autofire's press-to-press time), against the intended period.
+    Written under the player's lock.
+    """
+
+    __slots__ = ('count', 'total_ns', 'min_ns', 'max_ns', 'error_max_ns', 'within_1ms')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = self.total_ns = self.max_ns = self.error_max_ns = self.within_1ms = 0
+        self.min_ns = 0
+
+    def record(self, interval_ns: int, period_ns: int):
+        if not self.count or interval_ns < self.min_ns:
+            self.min_ns = interval_ns
+        self.count += 1
+        self.total_ns += interval_ns
+        if interval_ns > self.max_ns:
+            self.max_ns = interval_ns
+        error = abs(interval_ns - period_ns)
+        if error > self.error_max_ns:
+            self.error_max_ns = error
+        if error <= 1_000_000:
+            self.within_1ms += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'intervals': self.count,
+            'interval_avg_ms': round(self.total_ns / self.count / 1e6, 3) if self.count else 0.0,
+            'interval_min_ms': round(self.min_ns / 1e6, 3),
+            'interval_max_ms': round(self.max_ns / 1e6, 3),
+            'error_max_ms': round(self.error_max_ns / 1e6, 3),
+            'within_1ms_pct': round(100 * self.within_1ms / self.count, 1) if self.count else 0.0,
+        }
+
+
+class Macro:
+    """
+    A compiled macro: 'frames' is a tuple of (steps, delay_ns) pairs,
+    each frame's (scan_code, value) steps emitted at once and followed by
+    its delay. The frames play 'repeat' times, 0 meaning until the trigger
+    key is released.
+    """
+
+    __slots__ = ('frames', 'repeat', 'period_ns')
+
+    def __init__(self, frames: Tuple[Tuple[Tuple[Tuple[int, int], ...], int], ...], repeat: int = 1):
+        self.frames = frames
+        self.repeat = repeat
+        self.period_ns = sum(delay for _, delay in frames)
+
+    @staticmethod
+    def autofire(action: OutputAction, rate_hz: float) -> 'Macro':
+        """Taps 'action' at 'rate_hz' until stopped, down half of each period.
+        Its runs keep the scheduler precise (see LATENESS_TARGET_NS)."""
+        period_ns = int(1e9 / rate_hz)
+        return Macro(((action.press_steps, period_ns // 2),
+                      (action.release_steps, period_ns - period_ns // 2)), 0)
+
+    @staticmethod
+    def key_repeat(action: OutputAction, rate_hz: float) -> 'Macro':
+        """Presses 'action' again at 'rate_hz' until stopped, as the OS
+        auto-repeat does (no release in between)."""
+        return Macro(((action.press_steps, int(1e9 / rate_hz)),), 0)
+
+    @staticmethod
+    def compile(text: str) -> 'Macro':
+        """
+        Compiles a macro: comma-separated steps, played in order.
+          'ctrl+c'        tap (press, then release)
+          'down shift'    press only;  'up shift'  release only
+          '50ms'          wait
+          'step * 3'      the step three times ('a*3', '10ms*5')
+          'repeat [N]'    last step: play the macro N times (no N: until
+                          the trigger key is released)
+        Raises ValueError for bad syntax or an unknown key name; other
+        exceptions mean the OS key tables are not available yet.
+        """
+        parts = [part.strip() for part in text.split(',')]
+        if not all(parts):
+            raise ValueError(f"empty macro step in {text!r}")
+
+        repeat = 1
+        if parts[-1].split()[0] == 'repeat':
+            words = parts.pop().split()
+            if len(words) > 2 or (len(words) == 2 and not words[1].isdigit()):
+                raise ValueError(f"bad repeat step in {text!r}")
+            repeat = int(words[1]) if len(words) == 2 else 0
+            if repeat > MAX_REPEAT_COUNT:
+                raise ValueError(f"repeat count over {MAX_REPEAT_COUNT}")
+        if not parts:
+            raise ValueError("macro without steps")
+
+        frames: List[list] = [[[], 0]]
+        for part in parts:
+            count = 1
+            match = _COUNT.fullmatch(part)
+            if match:
+                part, count = match.group(1), int(match.group(2))
+                if not 1 <= count <= MAX_STEP_COUNT:
+                    raise ValueError(f"step count out of range in {text!r}")
+
+            match = _DELAY.fullmatch(part)
+            if match:
+                frames[-1][1] += int(float(match.group(1)) * 1_000_000) * count
+                continue
+
+            words = part.split(None, 1)
+            if len(words) == 2 and words[0] in ('down', 'up'):
+                action = OutputAction.compile(words[1])
+                steps = action.press_steps if words[0] == 'down' else action.release_steps
+            else:
+                action = OutputAction.compile(part)
+                steps = action.press_steps + action.release_steps
+            if frames[-1][1]:
+                frames.append([[], 0])
+            frames[-1][0].extend(steps * count)
+
+        if repeat == 0 and not any(delay for _, delay in frames):
+            raise ValueError("a macro repeated until release needs a delay")
+        return Macro(tuple((tuple(steps), delay) for steps, delay in frames), repeat)
+
+
+class _Run:
+    """A macro being played: where it is and what it holds down."""
+
+    __slots__ = ('macro', 'frame', 'loops', 'deadline_ns', 'timer', 'down', 'loop_start_ns',
+                 'stopping')
+
+    def __init__(self, macro: Macro):
+        self.macro = macro
+        self.frame = 0
+        self.loops = 0
+        self.deadline_ns = 0
+        self.timer: Optional[TimerHandle] = None
+        self.down: Set[int] = set()
+        self.loop_start_ns = 0
+        # Stopped before its first frame played: plays up to the first delay
+        self.stopping = False
+
+
+class MacroPlayer:
+    """
+    Plays macros on the scheduler thread: the hook only starts or cancels
+    a run, it never sleeps. Each frame is scheduled at the previous
+    frame's deadline plus its delay (absolute monotonic deadlines), so
+    late callbacks do not add up over a long macro.
+
+    A run is keyed by its trigger (one run per key, so auto-repeat does
+    not restart it) and cancelled by stop(): trigger released, focus
+    change, rule edit or hook stop. Keys it left down are released. A
+    trigger released before the scheduler got to the run still plays the
+    steps up to the first delay, so a quick tap is never lost.
+    While runs with delays are playing the scheduler is kept precise
+    (Scheduler.begin_precise), and the loop intervals of repeating ones
+    go to 'stats'.
+    """
+
+    def __init__(self, emit: Callable, scheduler: Scheduler):
+        self.emit = emit
+        self.scheduler = scheduler
+        self.stats = RepeatStats()
+        self._lock = threading.Lock()
+        self._runs: Dict[object, _Run] = {}
+
+    def start(self, key, macro: Macro, delay_ns: int = 0):
+        """Starts playing 'macro' for trigger 'key' (after 'delay_ns')
+        unless it is playing."""
+        with self._lock:
+            if key not in self._runs:
+                self._start(key, macro, delay_ns)
+
+    def toggle(self, key, macro: Macro):
+        """Starts playing 'macro' for 'key', or stops it if it is playing."""
+        with self._lock:
+            run = self._runs.pop(key, None)
+            if run is not None:
+                self._cancel(run)
+            else:
+                self._start(key, macro)
+
+    def _start(self, key, macro: Macro, delay_ns: int = 0):
+        run = self._runs[key] = _Run(macro)
+        run.deadline_ns = time.monotonic_ns() + delay_ns
+        if macro.period_ns:
+            self.scheduler.begin_precise()
+        self._arm(key, run)
+
+    def _arm(self, key, run: _Run):
+        run.timer = self.scheduler.call_at(run.deadline_ns, lambda: self._play(key, run))
+
+    def _play(self, key, run: _Run):
+        """Emits frames up to the next delay (scheduler thread)."""
+        with self._lock:
+            if self._runs.get(key) is not run:
+                return
+            macro = run.macro
+            frames = macro.frames
+            while True:
+                if run.frame == 0 and macro.period_ns:
+                    now = time.monotonic_ns()
+                    if run.loops:
+                        self.stats.record(now - run.loop_start_ns, macro.period_ns)
+                    run.loop_start_ns = now
+                steps, delay_ns = frames[run.frame]
+                self._emit(run, steps)
+                run.frame += 1
+                if run.frame == len(frames):
+                    run.frame = 0
+                    run.loops += 1
+                    if macro.repeat and run.loops >= macro.repeat:
+                        self._finish(run)
+                        # Keys it left down ('down shift') wait for stop()
+                        if run.stopping or not run.down:
+                            del self._runs[key]
+                            self._cancel(run)
+                        return
+                if delay_ns:
+                    if run.stopping:
+                        del self._runs[key]
+                        self._cancel(run)
+                        return
+                    run.deadline_ns += delay_ns
+                    self._arm(key, run)
+                    return
+
+    def _emit(self, run: _Run, steps):
+        if not steps:
+            return
+        down = run.down
+        for scan_code, value in steps:
+            if value:
+                down.add(scan_code)
+            else:
+                down.discard(scan_code)
+        try:
+            self.emit(steps)
+        except Exception as e:
+            logger.error(f"Failed to play macro step: {e}", exc_info=True)
+
+    def stop(self, key, release: bool = True):
+        """Cancels the run of trigger 'key', releasing what it holds
+        (unless 'release' is False: the caller releases it, so a run that
+        has played nothing yet is dropped rather than tapped after the
+        caller's release)."""
+        with self._lock:
+            run = self._runs.get(key)
+            if run is None:
+                return
+            if (release and run.frame == 0 and run.loops == 0 and run.timer is not None
+                    and run.deadline_ns <= time.monotonic_ns()):
+                # Due but not played yet (a delayed start is just dropped)
+                run.stopping = True
+                return
+            del self._runs[key]
+            if not release:
+                run.down.clear()
+            self._cancel(run)
+
+    def stop_all(self):
+        with self._lock:
+            runs = list(self._runs.values())
+            self._runs.clear()
+            for run in runs:
+                self._cancel(run)
+
+    def _finish(self, run: _Run):
+        """The run plays nothing more: gives back the precise timing."""
+        if run.timer is not None:
+            run.timer = None
+            if run.macro.period_ns:
+                self.scheduler.end_precise()
+
+    def _cancel(self, run: _Run):
+        if run.timer is not None:
+            run.timer.cancel()
+            self._finish(run)
+        if run.down:
+            steps = tuple((scan_code, 0) for scan_code in run.down)
+            run.down.clear()
+            self._emit(run, steps)
@@ -0,0 +1,576 @@
+"""
+Compiled rule snapshots for the hook thread
+Key names are resolved to scan codes once, at compile time
+"""
+
+import keyboard
+from keyboard._canonical_names import normalize_name
+from itertools import combinations
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Mapping, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from .key_handler import KeyRule
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Linux KEY_MAX is 0x2ff: every evdev key code fits in this many slots.
+# Windows codes are scan codes (< 0x100) or -vk for keys without one; the
+# negative ones land in the overflow dict instead.
+SCAN_CODE_SLOTS = 768
+
+
+def resolve_scan_codes(name: str) -> Tuple[int, ...]:
+    """
+    Scan codes the OS reports for a key name, or () when they cannot be
+    resolved (unknown name, or the keyboard tables are not available yet,
+    e.g. Linux before the first hook has been installed).
+    """
+    try:
+        return tuple(keyboard.key_to_scan_codes(name))
+    except Exception:
+        return ()
+
+
+# Modifier bits of combo rules ('ctrl+j'). Held state keeps one bit per
+# side: the left key sets the low nibble and the right key the high one,
+# so releasing one side does not clear the other; combo lookup folds both
+# sides into the low nibble.
+MOD_CTRL = 0x1
+MOD_SHIFT = 0x2
+MOD_ALT = 0x4
+MOD_WINDOWS = 0x8
+RIGHT_SIDE_SHIFT = 4
+
+MODIFIER_BITS = {
+    'ctrl': MOD_CTRL,
+    'shift': MOD_SHIFT,
+    'alt': MOD_ALT,
+    'windows': MOD_WINDOWS,
+}
+_SIDED_MODIFIER_NAMES = {
+    f'{side} {modifier}': (modifier, side)
+    for modifier in MODIFIER_BITS for side in ('left', 'right')
+}
+_SIDED_MODIFIER_NAMES['alt gr'] = ('alt', 'right')
+
+
+def parse_combo(name: str) -> Tuple[int, str]:
+    """
+    Splits a source key into (modifier mask, key name): 'ctrl+j' ->
+    (MOD_CTRL, 'j'), 'j' -> (0, 'j'). A side-specific modifier ('left
+    ctrl+j') matches either side. Raises ValueError if a part before the
+    key is not a modifier.
+    """
+    parts = [part.strip() for part in name.split('+')]
+    if len(parts) < 2 or not all(parts):
+        # A single key, or the '+' key itself
+        return 0, name
+    mask = 0
+    for part in parts[:-1]:
+        modifier = normalize_name(part)
+        modifier = _SIDED_MODIFIER_NAMES.get(modifier, (modifier, None))[0]
+        if modifier not in MODIFIER_BITS:
+            raise ValueError(f"'{part}' is not a modifier")
+        mask |= MODIFIER_BITS[modifier]
+    return mask, parts[-1]
+
+
+def parse_chord(name: str) -> Optional[Tuple[str, ...]]:
+    """
+    Keys of a chord source ('j+k': pressed together, in any order), or None
+    if 'name' is not a chord. A chord has two or more parts and none of
+    them is a modifier (that would be a combo).
+    """
+    parts = [part.strip() for part in name.split('+')]
+    if len(parts) < 2 or not all(parts):
+        return None
+    for part in parts:
+        key = normalize_name(part)
+        if key in MODIFIER_BITS or key in _SIDED_MODIFIER_NAMES:
+            return None
+    return tuple(parts)
+
+
+def parse_sequence(name: str) -> Optional[Tuple[str, ...]]:
+    """
+    Keys of a sequence source ('f12, g, s': typed one after another), or
+    None if 'name' is not a sequence. The ',' key alone is not one.
+    """
+    parts = [part.strip() for part in name.split(',')]
+    if len(parts) < 2 or not all(parts):
+        return None
+    return tuple(parts)
+
+
+def check_source(name: str, layer: str = ""):
+    """Raises ValueError if 'name' is not a key, a combo, a chord or a
+    sequence of single keys. Rules on a layer take a single key."""
+    if layer:
+        if (parse_sequence(name) is not None or parse_chord(name) is not None
+                or parse_combo(name)[0]):
+            raise ValueError("layer rules take a single key")
+        return
+    sequence = parse_sequence(name)
+    if sequence is not None:
+        for key in sequence:
+            if parse_chord(key) is not None or parse_combo(key)[0]:
+                raise ValueError(f"sequence step '{key}' is not a single key")
+    elif parse_chord(name) is None:
+        parse_combo(name)
+
+
+# Modes of the rules that switch layers instead of typing: their
+# replacement_key is the name of the layer
+LAYER_MODES = ('layer', 'layer_lock')
+# Modes of the rules that pair two opposing keys (SOCD, e.g. 'a' with 'd'):
+# replacement_key is the opposing key; both keys type themselves, resolved
+# by last-input priority ('socd') or cancelling out ('socd_neutral')
+SOCD_MODES = ('socd', 'socd_neutral')
+
+
+def check_socd_pair(first: str, second: str, layer: str = ""):
+    """Raises ValueError unless 'first' and 'second' are two different
+    single keys on the base layer."""
+    if layer:
+        raise ValueError("SOCD pairs are not layered")
+    for name in (first, second):
+        if (parse_sequence(name) is not None or parse_chord(name) is not None
+                or parse_combo(name)[0]):
+            raise ValueError(f"'{name}' is not a single key")
+    if first == second:
+        raise ValueError("an SOCD pair needs two different keys")
+
+
+# What a rule does with the source key's auto-repeat: forward it to the
+# handler, drop it, or drop it and repeat the output at the engine's own
+# rate (KeyRule.repeat_policy gives the mode's default)
+REPEAT_POLICIES = ('pass', 'drop', 'generate')
+
+
+# Layer bit 0 is the base layer (rules without a layer), always active
+BASE_LAYER = 0x1
+
+
+def rule_key(key_to_replace: str, layer: str = ""):
+    """Key of a rule in the active-rules map: the source key name, or
+    (layer, name) for a rule on a layer."""
+    return (layer, key_to_replace) if layer else key_to_replace
+
+
+def modifier_scan_code_bits() -> bytearray:
+    """
+    Held-state bit for each modifier scan code (0 for other keys), from the
+    OS key tables. Keys that only resolve by their generic name count as
+    the left side.
+    """
+    bits = bytearray(SCAN_CODE_SLOTS)
+    for name, (modifier, side) in _SIDED_MODIFIER_NAMES.items():
+        bit = MODIFIER_BITS[modifier] << (RIGHT_SIDE_SHIFT if side == 'right' else 0)
+        for scan_code in resolve_scan_codes(name):
+            if 0 <= scan_code < SCAN_CODE_SLOTS and not bits[scan_code]:
+                bits[scan_code] = bit
+    for modifier, bit in MODIFIER_BITS.items():
+        for scan_code in resolve_scan_codes(modifier):
+            if 0 <= scan_code < SCAN_CODE_SLOTS and not bits[scan_code]:
+                bits[scan_code] = bit
+    return bits
+
+
+class OutputAction:
+    """
+    A replacement key compiled into ready-to-emit (scan_code, value) steps.
+
+    Built once when the rule is created, so the hook thread never parses
+    hotkey strings or resolves names: it just writes the steps. Supports
+    multi-key replacements ('ctrl+shift+t'); like keyboard.press/release,
+    keys are pressed in order and released in reverse order per step.
+    'mask' has the bit of every key it presses (bit n = scan code n);
+    'other_codes' the keys a bit cannot stand for (negative codes: Windows
+    virtual keys without a scan code, e.g. media keys).
+    """
+
+    __slots__ = ('press_steps', 'release_steps', 'mask', 'other_codes')
+
+    def __init__(self, press_steps: Tuple[Tuple[int, int], ...],
+                 release_steps: Tuple[Tuple[int, int], ...]):
+        self.press_steps = press_steps
+        self.release_steps = release_steps
+        self.mask = 0
+        for scan_code, _ in press_steps:
+            if scan_code >= 0:
+                self.mask |= 1 << scan_code
+        self.other_codes = frozenset(scan_code for scan_code, _ in press_steps if scan_code < 0)
+
+    @staticmethod
+    def compile(hotkey: str) -> 'OutputAction':
+        """
+        Compiles a replacement key. Raises ValueError for an unknown key
+        name; other exceptions mean the OS key tables are not available yet.
+        """
+        parsed = keyboard.parse_hotkey(hotkey)
+        press_steps = tuple((scan_codes[0], 1) for step in parsed for scan_codes in step)
+        release_steps = tuple((scan_codes[0], 0) for step in parsed for scan_codes in reversed(step))
+        return OutputAction(press_steps, release_steps)
+
+
+class SequenceNode:
+    """A trie node of sequence rules: the keys that can come next and the
+    rule that ends here, if any."""
+
+    __slots__ = ('children', 'rule')
+
+    def __init__(self):
+        self.children: Dict[int, 'SequenceNode'] = {}
+        self.rule: Optional['KeyRule'] = None
+
+
+class CompiledRuleset:
+    """
+    Immutable dispatch snapshot built from the active rules.
+
+    'slots' is a flat list indexed by scan code, so the hook resolves a
+    rule with a single index instead of hashing the event's key name.
+    Rules whose name could not be resolved are kept in 'unresolved' and
+    matched by name, so nothing is lost while the tables are unavailable.
+
+    Combo rules ('ctrl+j') live in 'combos', keyed by
+    combo_key(scan_code, modifier mask), next to 'modifier_bits' (the
+    held-state bit of each modifier scan code) to track that mask.
+
+    Chord rules ('j+k') live in 'chords', keyed by the set of their scan
+    codes. 'chord_keys' flags (per scan code) the keys that can start a
+    chord and 'chord_prefixes' holds every partial set that can still
+    become one, so the chord engine decides each key with a lookup.
+
+    Sequence rules ('f12, g, s') form a trie of SequenceNode keyed by scan
+    code, rooted at 'sequences', so the sequence engine follows one dict
+    hop per key however many sequences exist. 'sequence_keys' flags the
+    keys that start one (the root's children).
+
+    SOCD rules pair two opposing keys: 'socd_pairs' holds (first code,
+    second code, neutral) per pair and 'socd_keys' maps each paired scan
+    code to its pair index + 1 (0: not paired).
+
+    Rules on layers ('layer' set) get a slots table per layer in
+    'layer_slots', in stacking order. 'layer_masks' holds, per scan code,
+    the bits of the layers that map it (BASE_LAYER for 'slots', 1 << (i+1)
+    for layer i), so the top-most active layer with a rule for a key is
+    the highest bit of (layer_masks[code] & active): one AND and a
+    bit_length, however many layers there are. Both are empty/None
+    without layers.
+
+    'repeat_drops' flags the scan codes whose auto-repeat no handler
+    wants (the base rule on the code drops or generates repeats and no
+    layer or combo rule could take it instead, or a tap-hold or SOCD
+    engine owns it), so the input backend can discard kernel repeats
+    before the hook. None when there are none.
+
+    'scan_code_filter' is the same table as a bitset (one byte per code)
+    for input backends that can skip the hook for unmapped keys. It is
+    None when some rule is only known by name: then every key matters.
+    """
+
+    __slots__ = ('rules', 'slots', 'overflow', 'unresolved', 'combos', 'modifier_bits',
+                 'chords', 'chord_keys', 'chord_prefixes', 'layers', 'layer_slots',
+                 'layer_masks', 'sequences', 'sequence_keys', 'socd_pairs', 'socd_keys',
+                 'repeat_drops', 'scan_code_filter')
+
+    def __init__(self, rules: Mapping[object, 'KeyRule'], layer_order: Tuple[str, ...] = ()):
+        """'rules' is keyed by rule_key(); layers stack in 'layer_order'
+        (the last one on top), then in order of appearance."""
+        self.rules = rules
+        self.slots: List[Optional['KeyRule']] = [None] * SCAN_CODE_SLOTS
+        self.overflow: Dict[int, 'KeyRule'] = {}
+        self.unresolved: Dict[str, 'KeyRule'] = {}
+        self.combos: Dict[int, 'KeyRule'] = {}
+        self.modifier_bits: Optional[bytearray] = None
+        self.chords: Dict[FrozenSet[int], 'KeyRule'] = {}
+        self.chord_keys: Optional[bytearray] = None
+        self.chord_prefixes: Set[FrozenSet[int]] = set()
+        self.sequences = SequenceNode()
+        self.sequence_keys: Optional[bytearray] = None
+        self.socd_pairs: List[Tuple[int, int, bool]] = []
+        self.socd_keys: Optional[bytearray] = None
+
+        layers = dict.fromkeys(layer_order)
+        layers.update(dict.fromkeys(rule.layer for rule in rules.values() if rule.layer))
+        self.layers: Tuple[str, ...] = tuple(layers)
+        self.layer_slots: List[List[Optional['KeyRule']]] = [
+            [None] * SCAN_CODE_SLOTS for _ in self.layers]
+        self.layer_masks: Optional[List[int]] = None
+
+        hook_codes = set()
+        layer_index = {layer: index for index, layer in enumerate(self.layers)}
+        for name, rule in rules.items():
+            if rule.layer:
+                if not self._bind_layer(layer_index[rule.layer], rule, hook_codes):
+                    self.unresolved[name] = rule
+                continue
+            if rule.mode in SOCD_MODES:
+                if not self._bind_socd(rule, hook_codes):
+                    self.unresolved[name] = rule
+                continue
+            name = rule.key_to_replace
+            sequence = parse_sequence(name)
+            if sequence is not None:
+                if not self._bind_sequence(sequence, rule):
+                    self.unresolved[name] = rule
+                continue
+            chord = parse_chord(name)
+            if chord is not None:
+                if not self._bind_chord(chord, rule):
+                    self.unresolved[name] = rule
+                continue
+            try:
+                mask, key = parse_combo(name)
+            except ValueError as e:
+                logger.warning(f"Invalid source key '{name}': {e}")
+                continue
+            scan_codes = resolve_scan_codes(key)
+            if not scan_codes:
+                # Combos are never matched by name; they wait in here
+                # (disabling the filter) until the tables are available
+                self.unresolved[name] = rule
+                continue
+            for scan_code in scan_codes:
+                if mask:
+                    self._bind_combo(scan_code, mask, rule)
+                    hook_codes.add(scan_code)
+                else:
+                    self._bind(scan_code, rule)
+
+        if self.combos:
+            self.modifier_bits = modifier_scan_code_bits()
+        if self.chords:
+            self.chord_keys = bytearray(SCAN_CODE_SLOTS)
+            for codes in self.chords:
+                for size in range(1, len(codes)):
+                    self.chord_prefixes.update(map(frozenset, combinations(codes, size)))
+                for scan_code in codes:
+                    self.chord_keys[scan_code] = 1
+                    hook_codes.add(scan_code)
+
+        if self.sequences.children:
+            self.sequence_keys = bytearray(SCAN_CODE_SLOTS)
+            for scan_code in self.sequences.children:
+                self.sequence_keys[scan_code] = 1
+                hook_codes.add(scan_code)
+
+        if self.layers:
+            self.layer_masks = [BASE_LAYER if rule is not None else 0 for rule in self.slots]
+            for index, table in enumerate(self.layer_slots):
+                bit = 2 << index
+                for scan_code, rule in enumerate(table):
+                    if rule is not None:
+                        self.layer_masks[scan_code] |= bit
+
+        self.repeat_drops = self._repeat_drops()
+
+        self.scan_code_filter: Optional[bytearray] = None
+        if not self.unresolved:
+            self.scan_code_filter = bytearray(rule is not None for rule in self.slots)
+            for scan_code in hook_codes:
+                if 0 <= scan_code < SCAN_CODE_SLOTS:
+                    self.scan_code_filter[scan_code] = 1
+
+    def _repeat_drops(self) -> Optional[bytearray]:
+        """Scan codes whose auto-repeat every handler of them discards.
+        Only what owns a key whatever the layer and modifiers can drop it:
+        a layer or combo rule leaves the key to the base rule (or to the
+        system) the rest of the time, so it always keeps the repeats."""
+        drops = bytearray(SCAN_CODE_SLOTS)
+        kept = bytearray(SCAN_CODE_SLOTS)
+        for scan_code, rule in enumerate(self.slots):
+            if rule is not None and rule.repeat_policy != 'pass':
+                drops[scan_code] = 1
+        for table in self.layer_slots:
+            for scan_code, rule in enumerate(table):
+                if rule is not None:
+                    kept[scan_code] = 1
+        for key in self.combos:
+            scan_code = key >> 4
+            if 0 <= scan_code < SCAN_CODE_SLOTS:
+                kept[scan_code] = 1
+        for scan_code, rule in enumerate(self.slots):
+            # Decided by the tap-hold engine, which swallows repeats
+            if rule is not None and rule.mode == 'tap_hold':
+                drops[scan_code], kept[scan_code] = 1, 0
+        if self.socd_keys is not None:
+            for scan_code, pair in enumerate(self.socd_keys):
+                if pair:
+                    drops[scan_code], kept[scan_code] = 1, 0
+        for scan_code, used in enumerate(kept):
+            if used:
+                drops[scan_code] = 0
+        return drops if any(drops) else None
+
+    def _bind(self, scan_code: int, rule: 'KeyRule'):
+        """Points a scan code at a rule. The first rule to claim a code wins
+        (e.g. 'ctrl' and 'left ctrl' both resolve to the left ctrl code)."""
+        if 0 <= scan_code < SCAN_CODE_SLOTS:
+            current = self.slots[scan_code]
+        else:
+            current = self.overflow.get(scan_code)
+        if current is not None:
+            logger.warning(
+                f"Scan code {scan_code} already mapped by '{current.key_to_replace}', "
+                f"ignored for '{rule.key_to_replace}'")
+            return
+        if 0 <= scan_code < SCAN_CODE_SLOTS:
+            self.slots[scan_code] = rule
+        else:
+            self.overflow[scan_code] = rule
+
+    def _bind_combo(self, scan_code: int, mask: int, rule: 'KeyRule'):
+        """Same as _bind, for a (scan_code, modifier mask) pair."""
+        key = combo_key(scan_code, mask)
+        current = self.combos.get(key)
+        if current is not None:
+            logger.warning(
+                f"Combo already mapped by '{current.key_to_replace}', "
+                f"ignored for '{rule.key_to_replace}'")
+            return
+        self.combos[key] = rule
+
+    def _bind_chord(self, keys: Tuple[str, ...], rule: 'KeyRule') -> bool:
+        """Adds a chord. Returns False if a key cannot be resolved yet."""
+        codes = []
+        for key in keys:
+            scan_codes = [code for code in resolve_scan_codes(key) if 0 <= code < SCAN_CODE_SLOTS]
+            if not scan_codes:
+                return False
+            codes.append(scan_codes[0])
+        chord = frozenset(codes)
+        if len(chord) < 2:
+            logger.warning(f"Chord '{rule.key_to_replace}' repeats a key, ignored")
+            return True
+        current = self.chords.get(chord)
+        if current is not None:
+            logger.warning(
+                f"Chord already mapped by '{current.key_to_replace}', "
+                f"ignored for '{rule.key_to_replace}'")
+            return True
+        self.chords[chord] = rule
+        return True
+
+    def _bind_sequence(self, keys: Tuple[str, ...], rule: 'KeyRule') -> bool:
+        """Adds a sequence to the trie. Returns False if a key cannot be
+        resolved yet."""
+        codes = []
+        for key in keys:
+            scan_codes = [code for code in resolve_scan_codes(key) if 0 <= code < SCAN_CODE_SLOTS]
+            if not scan_codes:
+                return False
+            codes.append(scan_codes[0])
+        node = self.sequences
+        for scan_code in codes:
+            child = node.children.get(scan_code)
+            if child is None:
+                child = node.children[scan_code] = SequenceNode()
+            node = child
+        if node.rule is not None:
+            logger.warning(
+                f"Sequence already mapped by '{node.rule.key_to_replace}', "
+                f"ignored for '{rule.key_to_replace}'")
+        else:
+            node.rule = rule
+        return True
+
+    def _bind_socd(self, rule: 'KeyRule', hook_codes: Set[int]) -> bool:
+        """Adds an SOCD pair. Returns False if a key cannot be resolved
+        yet."""
+        try:
+            check_socd_pair(rule.key_to_replace, rule.replacement_key)
+        except ValueError as e:
+            logger.warning(f"Invalid SOCD pair '{rule.key_to_replace}' / '{rule.replacement_key}': {e}")
+            return True
+        codes = []
+        for key in (rule.key_to_replace, rule.replacement_key):
+            scan_codes = [code for code in resolve_scan_codes(key) if 0 <= code < SCAN_CODE_SLOTS]
+            if not scan_codes:
+                return False
+            codes.append(scan_codes[0])
+        if self.socd_keys is None:
+            self.socd_keys = bytearray(SCAN_CODE_SLOTS)
+        for scan_code in codes:
+            if self.socd_keys[scan_code]:
+                logger.warning(
+                    f"Key '{scan_code}' already in an SOCD pair, ignored for "
+                    f"'{rule.key_to_replace}' / '{rule.replacement_key}'")
+                return True
+        self.socd_pairs.append((codes[0], codes[1], rule.mode == 'socd_neutral'))
+        for scan_code in codes:
+            self.socd_keys[scan_code] = len(self.socd_pairs)
+            hook_codes.add(scan_code)
+        return True
+
+    def _bind_layer(self, index: int, rule: 'KeyRule', hook_codes: Set[int]) -> bool:
+        """Points the scan codes of a layer rule at it. Returns False if the
+        key cannot be resolved yet."""
+        try:
+            check_source(rule.key_to_replace, rule.layer)
+        except ValueError as e:
+            logger.warning(f"Invalid source key '{rule.key_to_replace}' on layer '{rule.layer}': {e}")
+            return True
+        scan_codes = [code for code in resolve_scan_codes(rule.key_to_replace)
+                      if 0 <= code < SCAN_CODE_SLOTS]
+        if not scan_codes:
+            return False
+        table = self.layer_slots[index]
+        for scan_code in scan_codes:
+            current = table[scan_code]
+            if current is not None:
+                logger.warning(
+                    f"Scan code {scan_code} already mapped by '{current.key_to_replace}' "
+                    f"on layer '{rule.layer}', ignored for '{rule.key_to_replace}'")
+                continue
+            table[scan_code] = rule
+            hook_codes.add(scan_code)
+        return True
+
+    def layer_bits(self) -> Dict[str, int]:
+        """Active-mask bit of each layer, by name."""
+        return {layer: 2 << index for index, layer in enumerate(self.layers)}
+
+    def lookup(self, scan_code: int, name: str, modifiers: int = 0,
+               active_layers: int = BASE_LAYER) -> Optional['KeyRule']:
+        """
+        Rule for an event, by scan code first and by name as a fallback.
+        'modifiers' is the held-state mask: a matching combo wins over the
+        plain rule of the same key. 'active_layers' is the mask of active
+        layers: the top-most one mapping the key wins over the base rule.
+        """
+        if self.layer_masks is not None and 0 <= scan_code < SCAN_CODE_SLOTS:
+            top = (self.layer_masks[scan_code] & active_layers).bit_length()
+            if top > 1:
+                return self.layer_slots[top - 2][scan_code]
+        if self.combos:
+            mask = (modifiers | modifiers >> RIGHT_SIDE_SHIFT) & 0xF
+            if mask:
+                rule = self.combos.get(combo_key(scan_code, mask))
+                if rule is not None:
+                    return rule
+        if 0 <= scan_code < SCAN_CODE_SLOTS:
+            rule = self.slots[scan_code]
+        else:
+            rule = self.overflow.get(scan_code)
+        if rule is None and self.unresolved:
+            rule = self.unresolved.get(name)
+        return rule
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+
+def combo_key(scan_code: int, mask: int) -> int:
+    """Key of the combos table for a scan code and a (folded) modifier mask."""
+    return scan_code << 4 | mask
+
+
+EMPTY_RULESET = CompiledRuleset({})
@@ -0,0 +1,235 @@
+"""
+Timer scheduler for the key engine
+One thread runs every timed action (chord windows, timeouts) off the hook
+"""
+
+import heapq
+import itertools
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# The last stretch before a deadline is spun instead of slept: a sleeping
+# thread wakes up late by the OS timer slack (~1 ms on Linux, up to the
+# 15.6 ms tick on Windows).
+DEFAULT_SPIN_NS = 1_000_000
+
+# Interpreter switch interval while precise timers run (see
+# Scheduler.begin_precise): a thread waking up for a deadline waits up to
+# this long for the GIL when another thread keeps it busy (5 ms default).
+PRECISE_SWITCH_INTERVAL = 0.0005
+
+# Timing target of repeating timers (macros, autofire): start within 1 ms
+# of the deadline. It holds while the scheduler is precise (begin_precise),
+# which the macro player keeps for every run with delays; with the default
+# switch interval a busy thread can hold the GIL for 5 ms (see benchmark).
+LATENESS_TARGET_NS = 1_000_000
+
+# Lateness histogram: bucket i counts callbacks run less than 2**i us late
+_LATENESS_BUCKETS = 16
+
+
+class TimerHandle:
+    """A scheduled callback. cancel() is O(1): the heap entry is skipped."""
+
+    __slots__ = ('deadline_ns', 'callback', 'cancelled')
+
+    def __init__(self, deadline_ns: int, callback: Callable[[], None]):
+        self.deadline_ns = deadline_ns
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SchedulerStats:
+    """
+    Timing jitter of the scheduler: how late (ns) each callback started
+    after its deadline, and how many made LATENESS_TARGET_NS. Written by
+    the scheduler thread only.
+    """
+
+    __slots__ = ('count', 'total_ns', 'max_ns', 'on_target', 'buckets')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = self.total_ns = self.max_ns = self.on_target = 0
+        self.buckets = [0] * _LATENESS_BUCKETS
+
+    def record(self, late_ns: int):
+        if late_ns < 0:
+            late_ns = 0
+        self.count += 1
+        self.total_ns += late_ns
+        if late_ns > self.max_ns:
+            self.max_ns = late_ns
+        if late_ns <= LATENESS_TARGET_NS:
+            self.on_target += 1
+        self.buckets[min((late_ns // 1000).bit_length(), _LATENESS_BUCKETS - 1)] += 1
+
+    def _percentile_us(self, fraction: float) -> int:
+        """Upper bound (us) of the bucket holding the given fraction."""
+        wanted = self.count * fraction
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return 1 << index
+        return 1 << (_LATENESS_BUCKETS - 1)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'callbacks': self.count,
+            'late_avg_us': round(self.total_ns / self.count / 1000, 1) if self.count else 0.0,
+            'late_max_us': round(self.max_ns / 1000, 1),
+            'late_p50_us_below': self._percentile_us(0.5) if self.count else 0,
+            'late_p99_us_below': self._percentile_us(0.99) if self.count else 0,
+            'within_1ms_pct': round(100 * self.on_target / self.count, 1) if self.count else 0.0,
+        }
+
+
+class Scheduler:
+    """
+    Runs callbacks at time.monotonic_ns() deadlines on a single daemon
+    thread, started on first use.
+
+    Deadlines live in a heap, so scheduling and cancelling cost the same
+    with one timer pending or hundreds. Callbacks run one after another on
+    the scheduler thread and must be short; an exception is logged and does
+    not stop the thread. How late each callback starts is kept in 'stats'.
+    """
+
+    def __init__(self, name: str = "KeyForgeScheduler", spin_ns: int = DEFAULT_SPIN_NS):
+        self.name = name
+        self.spin_ns = spin_ns
+        self._heap: List[Tuple[int, int, TimerHandle]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self.stats = SchedulerStats()
+        self._precise = 0
+        self._saved_switch_interval = None
+
+    def call_at(self, deadline_ns: int, callback: Callable[[], None]) -> TimerHandle:
+        """Runs 'callback' at a time.monotonic_ns() deadline."""
+        handle = TimerHandle(deadline_ns, callback)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline_ns, next(self._counter), handle))
+            if self._heap[0][2] is handle:
+                # New earliest deadline: the thread must re-arm its wait
+                self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return handle
+
+    def call_later(self, delay_ns: int, callback: Callable[[], None]) -> TimerHandle:
+        """Runs 'callback' 'delay_ns' nanoseconds from now."""
+        return self.call_at(time.monotonic_ns() + delay_ns, callback)
+
+    def begin_precise(self):
+        """
+        Called when a repeating timer chain starts (macros, autofire):
+        lowers the interpreter switch interval until the matching
+        end_precise(), so a busy GUI thread cannot keep the scheduler
+        waiting for the GIL for whole milliseconds. Nests.
+        """
+        with self._cond:
+            self._precise += 1
+            if self._precise == 1:
+                self._saved_switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(min(self._saved_switch_interval, PRECISE_SWITCH_INTERVAL))
+
+    def end_precise(self):
+        with self._cond:
+            if self._precise == 0:
+                return
+            self._precise -= 1
+            if self._precise == 0:
+                sys.setswitchinterval(self._saved_switch_interval)
+
+    def _run(self):
+        heap = self._heap
+        cond = self._cond
+        while True:
+            with cond:
+                while not heap or heap[0][2].cancelled:
+                    if heap:
+                        heapq.heappop(heap)
+                    else:
+                        cond.wait()
+                deadline_ns = heap[0][0]
+                remaining = deadline_ns - time.monotonic_ns()
+                if remaining > self.spin_ns:
+                    cond.wait((remaining - self.spin_ns) / 1e9)
+                    continue
+
+            # Spin (yielding the GIL) up to the deadline
+            while time.monotonic_ns() < deadline_ns:
+                time.sleep(0)
+
+            with cond:
+                due = []
+                now = time.monotonic_ns()
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap)[2])
+
+            record = self.stats.record
+            for handle in due:
+                if handle.cancelled:
+                    continue
+                record(time.monotonic_ns() - handle.deadline_ns)
+                try:
+                    handle.callback()
+                except Exception as e:
+                    logger.error(f"Scheduled callback failed: {e}", exc_info=True)
+
+    @staticmethod
+    def benchmark(count: int = 1000, interval_ns: int = 1_000_000,
+                  spin_ns: int = DEFAULT_SPIN_NS, precise: bool = True,
+                  busy: bool = False) -> Dict[str, float]:
+        """
+        Runs a chain of 'count' timers, each 'interval_ns' after the
+        previous deadline (what a macro or autofire does), on a fresh
+        scheduler and returns its jitter stats ('within_1ms_pct' against
+        LATENESS_TARGET_NS). spin_ns=0 shows what plain sleeping gives,
+        precise=False the default switch interval, busy=True either with
+        another thread running Python code meanwhile (a busy GUI).
+        """
+        scheduler = Scheduler("KeyForgeSchedulerBenchmark", spin_ns)
+        if precise:
+            scheduler.begin_precise()
+        done = threading.Event()
+        if busy:
+            def spin():
+                while not done.is_set():
+                    sum(range(10000))
+            threading.Thread(target=spin, name="KeyForgeBusyBenchmark", daemon=True).start()
+        remaining = [count]
+        deadline = [time.monotonic_ns() + interval_ns]
+
+        def tick():
+            remaining[0] -= 1
+            if remaining[0] <= 0:
+                done.set()
+                return
+            deadline[0] += interval_ns
+            scheduler.call_at(deadline[0], tick)
+
+        scheduler.call_at(deadline[0], tick)
+        done.wait(count * interval_ns / 1e9 + 10)
+        if precise:
+            scheduler.end_precise()
+        return scheduler.stats.snapshot()
@@ -0,0 +1,241 @@
+"""
+Sequence rules ('f12, g, s' typed one after another -> output)
+Trie-walking engine layered in front of the compiled dispatch callback
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from .ruleset import SCAN_CODE_SLOTS, SequenceNode
+from .scheduler import Scheduler, TimerHandle
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+DEFAULT_SEQUENCE_TIMEOUT_MS = 1000
+
+
+class SequenceEngine:
+    """
+    Hook-callback layer for sequence rules.
+
+    A key that starts a sequence (the leader) is held back, and so is
+    every key after it while they keep following a branch of the trie:
+    one dict hop per key. Reaching a node with nothing after it fires its
+    rule; the held-back keys are swallowed and the output stays down until
+    the last key is released. A key off the trie, or no key within the
+    timeout of the previous one, ends the sequence: a node with a rule
+    fires it (a sequence that is also the start of a longer one waits for
+    the timeout), otherwise the held-back keys are flushed, in order,
+    through the inner dispatch and re-injected if nothing claims them.
+
+    The timeout is measured with the events' timestamps; the scheduler
+    only ends a sequence nobody continued, a timeout after the hook saw
+    its last key.
+
+    'callback' is the hook callback. Keys that cannot start a sequence go
+    straight to the inner dispatch when none is in progress: one table
+    index on top of it, no lock. While keys are held back or swallowed,
+    'route_all' asks the input backend for every key, so none overtakes
+    them and the releases of the swallowed ones are seen (the backend
+    only routes the first key of a sequence to the hook).
+    """
+
+    def __init__(self, root: SequenceNode, sequence_keys: bytearray,
+                 handlers: Dict[int, Callable[[bool], bool]], dispatch: Callable,
+                 replay: Callable[[int, int], None], route_all: Callable[[bool], None],
+                 monitor, scheduler: Scheduler, timeout_ms: float, key_down: str):
+        self.root = root
+        self.sequence_keys = sequence_keys
+        self.handlers = handlers    # id(rule) -> handler
+        self.dispatch = dispatch
+        self.replay = replay
+        self.route_all = route_all
+        self.monitor = monitor
+        self.scheduler = scheduler
+        self.timeout_ms = timeout_ms
+        self.key_down = key_down
+
+        self._lock = threading.Lock()
+        self._buffer: List = []             # Held-back events, in order
+        self._node: Optional[SequenceNode] = None
+        self._down: Set[int] = set()        # Sequence keys still down
+        self._last_time = 0.0               # Timestamp of the last sequence key
+        # One timer per sequence: each key only moves the deadline, and
+        # the timer re-arms itself until the deadline really passes
+        self._timer: Optional[TimerHandle] = None
+        self._deadline_ns = 0
+        # Keys of the sequence that fired, swallowed until released; the
+        # release of its last key ends the output
+        self._swallowed: Set[int] = set()
+        self._active_code: Optional[int] = None
+        self._active_handler: Optional[Callable[[bool], bool]] = None
+        self._routing_all = False
+
+        self.callback = self._make_callback()
+
+    def _make_callback(self):
+        """The hook callback: a closure, so the idle check reads locals
+        only (the buffer and swallowed set are mutated in place, never
+        rebound)."""
+        buffer, swallowed = self._buffer, self._swallowed
+        sequence_keys, key_down = self.sequence_keys, self.key_down
+        dispatch, lock, handle = self.dispatch, self._lock, self._handle
+
+        def callback(e):
+            if not buffer and not swallowed:
+                scan_code = e.scan_code
+                if (not 0 <= scan_code < SCAN_CODE_SLOTS or not sequence_keys[scan_code]
+                        or e.event_type != key_down):
+                    return dispatch(e)
+            with lock:
+                return handle(e)
+        return callback
+
+    def _handle(self, e) -> bool:
+        scan_code = e.scan_code
+        is_down = e.event_type == self.key_down
+
+        if scan_code in self._swallowed:
+            if not is_down:
+                self._swallowed.discard(scan_code)
+                if scan_code == self._active_code:
+                    handler, self._active_handler = self._active_handler, None
+                    self._active_code = None
+                    handler(False)
+                self._sync_routing()
+            return False
+
+        if self._buffer:
+            if (e.time - self._last_time) * 1000 > self.timeout_ms:
+                # The timer has not fired yet, but the timestamps are clear
+                self._end()
+            elif not is_down:
+                self._buffer.append(e)
+                self._down.discard(scan_code)
+                return False
+            elif scan_code in self._down:
+                return False  # Auto-repeat while waiting
+            else:
+                child = self._node.children.get(scan_code)
+                if child is not None:
+                    self._advance(e, child)
+                    return False
+                self._end()
+
+        if (is_down and 0 <= scan_code < SCAN_CODE_SLOTS and self.sequence_keys[scan_code]
+                and self.monitor.target_app_is_active):
+            self._advance(e, self.root.children[scan_code])
+            self._sync_routing()
+            return False
+
+        return self.dispatch(e)
+
+    def _advance(self, e, node: SequenceNode):
+        """Holds back a key that moved the sequence to 'node'."""
+        self._buffer.append(e)
+        self._down.add(e.scan_code)
+        self._node = node
+        self._last_time = e.time
+        if not node.children:
+            self._fire()
+            return
+        self._deadline_ns = time.monotonic_ns() + int(self.timeout_ms * 1_000_000)
+        if self._timer is None:
+            self._arm()
+
+    def _arm(self):
+        timer = None
+
+        def expire():
+            with self._lock:
+                if self._timer is not timer:
+                    return
+                if time.monotonic_ns() < self._deadline_ns:
+                    self._arm()
+                else:
+                    self._timer = None
+                    self._end()
+
+        timer = self._timer = self.scheduler.call_at(self._deadline_ns, expire)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _end(self):
+        """The sequence cannot go on: fire the rule ending here, if any."""
+        if self._node is not None and self._node.rule is not None:
+            self._fire()
+        else:
+            self._flush()
+
+    def _sync_routing(self):
+        """Routes every key to the hook while keys are held back or
+        swallowed."""
+        wanted = bool(self._buffer or self._swallowed)
+        if wanted != self._routing_all:
+            self._routing_all = wanted
+            self.route_all(wanted)
+
+    def _take(self) -> List:
+        """Empties the buffer and returns the events it held."""
+        self._cancel_timer()
+        events = self._buffer[:]
+        self._buffer.clear()
+        self._node = None
+        return events
+
+    def _fire(self):
+        handler = self.handlers[id(self._node.rule)]
+        events = self._take()
+        downs = [event.scan_code for event in events if event.event_type == self.key_down]
+        codes, last_code = set(downs), downs[-1]
+        held, self._down = self._down, set()
+        self._swallowed.update(held)
+
+        if self._active_handler is not None:
+            # The previous sequence's last key is still down
+            previous, self._active_handler = self._active_handler, None
+            self._active_code = None
+            previous(False)
+        handler(True)
+        if last_code in held:
+            self._active_code, self._active_handler = last_code, handler
+        else:
+            handler(False)
+        self._sync_routing()
+        # Releases of keys pressed before the sequence are not ours
+        self._play([event for event in events
+                    if event.event_type != self.key_down and event.scan_code not in codes])
+
+    def _flush(self):
+        """Plays the held-back keys, in order, as if no sequence existed."""
+        events = self._take()
+        self._down.clear()
+        self._sync_routing()
+        self._play(events)
+
+    def _play(self, events):
+        for event in events:
+            try:
+                if self.dispatch(event) is not False:
+                    self.replay(event.scan_code, 1 if event.event_type == self.key_down else 0)
+            except Exception as exc:
+                logger.error(f"Error flushing sequence key: {exc}", exc_info=True)
+
+    def reset(self):
+        """Flushes held-back keys and forgets a fired sequence (focus
+        change, stop): the releases of its keys may never reach the hook."""
+        with self._lock:
+            self._swallowed.clear()
+            self._active_code = None
+            self._active_handler = None
+            self._flush()
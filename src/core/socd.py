@@ -0,0 +1,141 @@
+"""
+SOCD rules (opposing keys such as 'a'/'d': "snap tap")
+Resolution layered in front of the compiled dispatch callback
+"""
+
+import time
+from typing import Callable, Dict, List, Tuple
+
+from .ruleset import SCAN_CODE_SLOTS
+
+# Per-pair state bits: the first and second key
+_FIRST, _SECOND, _BOTH = 0x1, 0x2, 0x3
+
+
+class SocdEngine:
+    """
+    Hook-callback layer for SOCD pairs (Simultaneous Opposing Cardinal
+    Directions).
+
+    Each pair keeps two 2-bit masks: the keys physically down and the keys
+    the system was told are down. On every event of a paired key the
+    wanted output is computed from the physical mask (both down: the last
+    one pressed, or neither with neutral resolution) and the differences
+    are emitted, releases first, in the same call: no lock, no timer, no
+    other thread. The physical events themselves are always blocked;
+    auto-repeat of a key already down is dropped.
+
+    'callback' is the hook callback. Unpaired keys go straight to the
+    inner dispatch after one table index.
+    """
+
+    def __init__(self, pairs: List[Tuple[int, int, bool]], socd_keys: bytearray,
+                 dispatch: Callable, emit: Callable, monitor, key_down: str):
+        self.pairs = pairs          # (first code, second code, neutral)
+        self.socd_keys = socd_keys  # scan code -> pair index + 1
+        self.dispatch = dispatch
+        self.emit = emit
+        self.monitor = monitor
+        self.key_down = key_down
+
+        self._held = [0] * len(pairs)   # Physical state per pair
+        self._out = [0] * len(pairs)    # Output state per pair
+        self._last = [0] * len(pairs)   # Bit of the last key pressed
+
+        self.callback = self._make_callback()
+
+    def _make_callback(self):
+        """The hook callback: a closure over the state lists (mutated in
+        place, never rebound)."""
+        pairs, socd_keys = self.pairs, self.socd_keys
+        held, out, last = self._held, self._out, self._last
+        dispatch, emit, monitor, key_down = self.dispatch, self.emit, self.monitor, self.key_down
+
+        def callback(e):
+            scan_code = e.scan_code
+            if not 0 <= scan_code < SCAN_CODE_SLOTS:
+                return dispatch(e)
+            index = socd_keys[scan_code] - 1
+            if index < 0 or not monitor.target_app_is_active:
+                return dispatch(e)
+            first, second, neutral = pairs[index]
+            bit = _FIRST if scan_code == first else _SECOND
+            state = held[index]
+            if e.event_type == key_down:
+                if state & bit:
+                    return False  # Auto-repeat
+                state |= bit
+                last[index] = bit
+            else:
+                state &= ~bit
+            held[index] = state
+
+            if state == _BOTH:
+                wanted = 0 if neutral else last[index]
+            else:
+                wanted = state
+            current = out[index]
+            if wanted != current:
+                out[index] = wanted
+                changed = wanted ^ current
+                steps = []
+                if changed & _FIRST and not wanted & _FIRST:
+                    steps.append((first, 0))
+                if changed & _SECOND and not wanted & _SECOND:
+                    steps.append((second, 0))
+                if wanted & ~current & _FIRST:
+                    steps.append((first, 1))
+                if wanted & ~current & _SECOND:
+                    steps.append((second, 1))
+                emit(tuple(steps))
+            return False
+        return callback
+
+    def reset(self):
+        """Releases the outputs and forgets the physical state (focus
+        change, rule edit, stop): releases may never reach the hook."""
+        steps = []
+        for index, (first, second, _) in enumerate(self.pairs):
+            current = self._out[index]
+            if current & _FIRST:
+                steps.append((first, 0))
+            if current & _SECOND:
+                steps.append((second, 0))
+            self._held[index] = self._out[index] = self._last[index] = 0
+        if steps:
+            self.emit(tuple(steps))
+
+    @staticmethod
+    def benchmark(rounds: int = 100000) -> Dict[str, float]:
+        """
+        Nanoseconds per paired-key event through the callback, with the
+        output step itself stubbed out: a strafe pattern (a, d over a,
+        release a, release d) under last-input priority and neutral
+        resolution.
+        """
+        class Monitor:
+            target_app_is_active = True
+
+        class Event:
+            __slots__ = ('event_type', 'scan_code')
+
+            def __init__(self, event_type, scan_code):
+                self.event_type = event_type
+                self.scan_code = scan_code
+
+        first, second = 30, 32
+        socd_keys = bytearray(SCAN_CODE_SLOTS)
+        socd_keys[first] = socd_keys[second] = 1
+        pattern = [Event('down', first), Event('down', second),
+                   Event('up', first), Event('up', second)]
+        results = {}
+        for label, neutral in (('last_input_ns', False), ('neutral_ns', True)):
+            engine = SocdEngine([(first, second, neutral)], socd_keys,
+                                lambda e: True, lambda steps: None, Monitor(), 'down')
+            callback = engine.callback
+            start = time.perf_counter_ns()
+            for _ in range(rounds):
+                for event in pattern:
+                    callback(event)
+            results[label] = round((time.perf_counter_ns() - start) / (rounds * len(pattern)), 1)
+        return results
@@ -0,0 +1,240 @@
+"""
+Tap-hold rules (tap: one key, hold: another, e.g. caps lock -> esc / ctrl)
+Decision engine layered in front of the compiled dispatch callback
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from .ruleset import OutputAction, SCAN_CODE_SLOTS
+from .scheduler import Scheduler, TimerHandle
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+DEFAULT_TAP_HOLD_TERM_MS = 200
+
+
+class TapHoldStats:
+    """
+    Decision counters, kept by the key handler across rule edits.
+
+    'decision' is how long after the key went down (event timestamp) the
+    tap or hold output was emitted: what the user waits for. 'tap_press'
+    is how long taps were held (press to release, event timestamps), the
+    number to compare with the term when tuning it.
+    """
+
+    __slots__ = ('taps', 'holds', 'permissive_holds', 'timeout_holds',
+                 'decision_total_ms', 'decision_max_ms', 'tap_press_total_ms', 'tap_press_max_ms')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.taps = self.holds = self.permissive_holds = self.timeout_holds = 0
+        self.decision_total_ms = self.decision_max_ms = 0.0
+        self.tap_press_total_ms = self.tap_press_max_ms = 0.0
+
+    def record(self, decision_ms: float):
+        self.decision_total_ms += decision_ms
+        if decision_ms > self.decision_max_ms:
+            self.decision_max_ms = decision_ms
+
+    def snapshot(self) -> Dict[str, float]:
+        decisions = self.taps + self.holds
+        return {
+            'taps': self.taps,
+            'holds': self.holds,
+            'permissive_holds': self.permissive_holds,
+            'timeout_holds': self.timeout_holds,
+            'decision_avg_ms': round(self.decision_total_ms / decisions, 3) if decisions else 0.0,
+            'decision_max_ms': round(self.decision_max_ms, 3),
+            'tap_press_avg_ms': round(self.tap_press_total_ms / self.taps, 3) if self.taps else 0.0,
+            'tap_press_max_ms': round(self.tap_press_max_ms, 3),
+        }
+
+
+class TapHoldEngine:
+    """
+    Hook-callback layer for tap-hold rules.
+
+    A tap-hold key going down is held back until it is decided:
+      * released within the term: tap (the tap output is typed);
+      * still down after the term: hold (the hold output goes down until
+        the key is released);
+      * another key pressed AND released while it is down: hold right
+        away ("permissive hold"), so fast 'caps+c' is ctrl+c even inside
+        the term. A key only pressed meanwhile waits for the decision.
+    Keys typed while undecided are held back and played, in order, after
+    the decision (through the inner dispatch, re-injected if nothing
+    claims them); 'route_all' makes the backend hand us every key so
+    none of them overtakes the held-back ones.
+
+    The term is measured with the events' own timestamps (evdev
+    timestamps on Linux), so a late hook thread does not turn a tap into
+    a hold. The scheduler timer only decides a key nobody released, a
+    term after the hook saw it go down.
+
+    'callback' is the hook callback. Other keys go straight to the inner
+    dispatch when nothing is undecided or held: one table index, no lock.
+    """
+
+    def __init__(self, actions: Dict[int, tuple], dispatch: Callable,
+                 replay: Callable[[int, int], None], emit: Callable,
+                 route_all: Callable[[bool], None], monitor, scheduler: Scheduler,
+                 term_ms: float, stats: TapHoldStats, key_down: str):
+        self.actions = actions      # scan code -> (tap OutputAction, hold OutputAction)
+        self.dispatch = dispatch
+        self.replay = replay
+        self.emit = emit
+        self.route_all = route_all
+        self.monitor = monitor
+        self.scheduler = scheduler
+        self.term_ms = term_ms
+        self.stats = stats
+        self.key_down = key_down
+
+        self.keys = bytearray(SCAN_CODE_SLOTS)
+        for scan_code in actions:
+            self.keys[scan_code] = 1
+
+        self._lock = threading.Lock()
+        # Undecided key-down event first, then the keys held back behind it
+        self._buffer: List = []
+        self._timer: Optional[TimerHandle] = None
+        # Keys decided as hold -> the hold output they keep down
+        self._held: Dict[int, OutputAction] = {}
+
+        self.callback = self._make_callback()
+
+    def _make_callback(self):
+        """The hook callback: a closure, so the idle check reads locals
+        only (the buffer and held dict are mutated in place, never
+        rebound)."""
+        buffer, held, keys = self._buffer, self._held, self.keys
+        dispatch, lock, handle = self.dispatch, self._lock, self._handle
+
+        def callback(e):
+            if not buffer and not held:
+                scan_code = e.scan_code
+                if not 0 <= scan_code < SCAN_CODE_SLOTS or not keys[scan_code]:
+                    return dispatch(e)
+            with lock:
+                return handle(e)
+        return callback
+
+    def _handle(self, e) -> bool:
+        scan_code = e.scan_code
+        is_down = e.event_type == self.key_down
+        buffer = self._buffer
+
+        if buffer:
+            first = buffer[0]
+            if (e.time - first.time) * 1000 >= self.term_ms:
+                # The timer has not fired yet, but the timestamps are clear
+                self.stats.timeout_holds += 1
+                self._decide(True)
+            elif scan_code == first.scan_code:
+                if is_down:
+                    return False  # Auto-repeat while undecided
+                self._decide(False, e.time)
+                return False
+            elif is_down or not any(event.scan_code == scan_code for event in buffer[1:]):
+                buffer.append(e)
+                return False
+            else:
+                # A key pressed and released inside the term: permissive
+                # hold. Its press is played (under the hold output) first.
+                self.stats.permissive_holds += 1
+                self._decide(True)
+
+        action = self._held.get(scan_code)
+        if action is not None:
+            if not is_down:
+                del self._held[scan_code]
+                self.emit(action.release_steps)
+            return False
+
+        if (is_down and 0 <= scan_code < SCAN_CODE_SLOTS and self.keys[scan_code]
+                and self.monitor.target_app_is_active):
+            self.route_all(True)
+            buffer.append(e)
+            timer = None
+
+            def expire():
+                with self._lock:
+                    if self._timer is timer:
+                        self.stats.timeout_holds += 1
+                        self._decide(True)
+
+            # Counted from now, not from the event's timestamp: if the hook
+            # runs late, the release may already be queued behind this
+            # event and must be seen (and timed by its timestamp) first
+            timer = self._timer = self.scheduler.call_later(
+                int(self.term_ms * 1_000_000), expire)
+            return False
+
+        return self.dispatch(e)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _decide(self, hold: bool, released_at: Optional[float] = None):
+        """Emits the output for the undecided key, then plays the keys held
+        back behind it."""
+        self._cancel_timer()
+        first = self._buffer[0]
+        events = self._buffer[1:]
+        self._buffer.clear()
+        tap_action, hold_action = self.actions[first.scan_code]
+
+        if hold:
+            self._held[first.scan_code] = hold_action
+            self.emit(hold_action.press_steps)
+            self.stats.holds += 1
+        else:
+            self.emit(tap_action.press_steps)
+            self.emit(tap_action.release_steps)
+            self.stats.taps += 1
+            press_ms = (released_at - first.time) * 1000
+            self.stats.tap_press_total_ms += press_ms
+            if press_ms > self.stats.tap_press_max_ms:
+                self.stats.tap_press_max_ms = press_ms
+        self.stats.record((time.time() - first.time) * 1000)
+
+        self.route_all(False)
+        self._play(events)
+
+    def _play(self, events):
+        """Plays held-back events as if they were arriving now (another
+        tap-hold key among them is held back again)."""
+        for event in events:
+            try:
+                if self._handle(event) is not False:
+                    self.replay(event.scan_code, 1 if event.event_type == self.key_down else 0)
+            except Exception as exc:
+                logger.error(f"Error playing held-back key: {exc}", exc_info=True)
+
+    def reset(self):
+        """Plays held-back keys (the undecided key itself is dropped) and
+        releases hold outputs (focus change, rule edit, stop): the source
+        releases may never reach the hook."""
+        with self._lock:
+            self._cancel_timer()
+            events = self._buffer[1:]
+            if self._buffer:
+                self._buffer.clear()
+                self.route_all(False)
+            for action in self._held.values():
+                self.emit(action.release_steps)
+            self._held.clear()
+            self._play(events)
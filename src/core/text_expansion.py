@@ -0,0 +1,271 @@
+"""
+Text expansion (';sig' typed -> a whole signature)
+Aho-Corasick automaton advanced once per typed character
+"""
+
+import random
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import keyboard
+from keyboard._canonical_names import normalize_name
+
+from .ruleset import resolve_scan_codes
+
+# Professional logger (imported from the utils module)
+try:
+    from ..utils.logger import get_logger
+    logger = get_logger()
+except ImportError:
+    import logging
+    logger = logging.getLogger(__name__)
+
+# Typed-state history kept for backspace (deeper than any abbreviation
+# in practice; older states are forgotten)
+_HISTORY_LIMIT = 64
+
+# Key names that type a character besides the one-character names
+CHARACTER_NAMES = {'space': ' '}
+
+
+def compile_text(text: str) -> Tuple[Tuple[int, int], ...]:
+    """
+    (scan_code, value) steps that type 'text' on the current layout, with
+    shift (or whatever the layout needs) around each character that needs
+    it. Characters the layout cannot type are skipped with a warning.
+    Raises other exceptions when the OS key tables are not available yet.
+    """
+    steps = []
+    modifier_codes: Dict[str, int] = {}
+    for letter in text:
+        try:
+            scan_code, modifiers = next(iter(keyboard._os_keyboard.map_name(normalize_name(letter))))
+        except (KeyError, ValueError, StopIteration):
+            logger.warning(f"Cannot type {letter!r} on this keyboard layout, skipped")
+            continue
+        codes = []
+        for modifier in modifiers:
+            if modifier not in modifier_codes:
+                modifier_codes[modifier] = (resolve_scan_codes(modifier) or (None,))[0]
+            if modifier_codes[modifier] is not None:
+                codes.append(modifier_codes[modifier])
+        steps.extend((code, 1) for code in codes)
+        steps.append((scan_code, 1))
+        steps.append((scan_code, 0))
+        steps.extend((code, 0) for code in reversed(codes))
+    return tuple(steps)
+
+
+class Snippet:
+    """An abbreviation and the text that replaces it."""
+
+    __slots__ = ('abbreviation', 'text', 'steps')
+
+    def __init__(self, abbreviation: str, text: str):
+        self.abbreviation = abbreviation
+        self.text = text
+        # Compiled on first use (the key tables may not exist yet)
+        self.steps: Optional[Tuple[Tuple[int, int], ...]] = None
+
+
+class _Node:
+    """
+    Trie node. Failure link, output and the transitions that follow
+    failure links are computed on demand and memoized for the automaton
+    version they were computed in, so a snippet edit only touches its own
+    path and bumps the version.
+    """
+
+    __slots__ = ('children', 'snippet', 'depth', 'parent', 'char',
+                 'version', 'fail', 'output', 'moves')
+
+    def __init__(self, parent: Optional['_Node'] = None, char: str = ''):
+        self.children: Dict[str, '_Node'] = {}
+        self.snippet: Optional[Snippet] = None
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.parent = parent
+        self.char = char
+        self.version = -1
+        self.fail: Optional['_Node'] = None
+        self.output: Optional[Snippet] = None
+        self.moves: Dict[str, '_Node'] = {}
+
+
+class TextExpander:
+    """
+    Aho-Corasick matcher over the typed characters.
+
+    feed() advances the automaton by one character and returns the
+    snippet whose abbreviation the typed text now ends with (the longest
+    one), if any. Every node memoizes its transitions (including the ones
+    reached through failure links), so once a state/character pair has
+    been seen the step is one dict lookup, whatever the number of
+    snippets; computing a missing one follows at most one failure link per
+    trie level.
+
+    add()/remove() change only the path of their abbreviation and bump
+    the version: the memoized links of the other nodes are recomputed
+    lazily, the next time typing reaches them. Edits and feeds are
+    serialized by a lock (uncontended on the typing path).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._root = _Node()
+        self._version = 0
+        self._snippets: Dict[str, Snippet] = {}
+        self._state = self._root
+        self._history: List[_Node] = []
+
+    def __len__(self) -> int:
+        return len(self._snippets)
+
+    def snippets(self) -> Mapping[str, str]:
+        """Abbreviation -> text of every snippet"""
+        return {abbreviation: snippet.text for abbreviation, snippet in self._snippets.items()}
+
+    def add(self, abbreviation: str, text: str):
+        """Adds (or replaces) a snippet: O(len(abbreviation))."""
+        if not abbreviation:
+            raise ValueError("empty abbreviation")
+        with self._lock:
+            node = self._root
+            for char in abbreviation:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _Node(node, char)
+                node = child
+            node.snippet = self._snippets[abbreviation] = Snippet(abbreviation, text)
+            self._invalidate()
+
+    def remove(self, abbreviation: str) -> bool:
+        """Removes a snippet and prunes the trie nodes only it used."""
+        with self._lock:
+            if self._snippets.pop(abbreviation, None) is None:
+                return False
+            node = self._root
+            for char in abbreviation:
+                node = node.children[char]
+            node.snippet = None
+            while node.parent is not None and not node.children and node.snippet is None:
+                del node.parent.children[node.char]
+                node = node.parent
+            self._invalidate()
+            return True
+
+    def set_snippets(self, snippets: Mapping[str, str]):
+        """Replaces the whole dictionary, touching only what changed."""
+        for abbreviation in [a for a in self._snippets if a not in snippets]:
+            self.remove(abbreviation)
+        for abbreviation, text in snippets.items():
+            current = self._snippets.get(abbreviation)
+            if current is None or current.text != text:
+                self.add(abbreviation, text)
+
+    def _invalidate(self):
+        # Memoized links of older versions are ignored (and recomputed)
+        # from now on; the typing state restarts from the root, since its
+        # node may have been pruned
+        self._version += 1
+        self._state = self._root
+        self._history.clear()
+
+    def _refresh(self, node: _Node):
+        """Recomputes a node's failure link and output for this version."""
+        node.version = self._version
+        node.moves.clear()
+        if node.parent is None:
+            node.fail = None
+            node.output = None
+            return
+        node.fail = self._root if node.parent is self._root else self._move(self._fail(node.parent), node.char)
+        fail = node.fail
+        if fail.version != self._version:
+            self._refresh(fail)
+        node.output = node.snippet or fail.output
+
+    def _fail(self, node: _Node) -> _Node:
+        if node.version != self._version:
+            self._refresh(node)
+        return node.fail
+
+    def _move(self, node: _Node, char: str) -> _Node:
+        """Automaton transition, memoized on the node."""
+        if node.version != self._version:
+            self._refresh(node)
+        target = node.moves.get(char)
+        if target is None:
+            child = node.children.get(char)
+            if child is not None:
+                target = child
+            elif node.parent is None:
+                target = node
+            else:
+                target = self._move(self._fail(node), char)
+            node.moves[char] = target
+        return target
+
+    def feed(self, char: str) -> Optional[Snippet]:
+        """Advances by one typed character. Returns the snippet to expand."""
+        with self._lock:
+            state = self._state
+            target = state.moves.get(char) if state.version == self._version else None
+            if target is None:
+                target = self._move(state, char)
+            if len(self._history) >= _HISTORY_LIMIT:
+                del self._history[0]
+            self._history.append(state)
+            self._state = target
+            if target.version != self._version:
+                self._refresh(target)
+            snippet = target.output
+            if snippet is not None:
+                self._state = self._root
+                self._history.clear()
+            return snippet
+
+    def backspace(self):
+        """Steps back one character (the typed text lost its last one)."""
+        with self._lock:
+            self._state = self._history.pop() if self._history else self._root
+
+    def reset(self):
+        """Forgets the typed text (cursor moved, focus changed...)."""
+        with self._lock:
+            self._state = self._root
+            self._history.clear()
+
+    @staticmethod
+    def benchmark(count: int = 10000, keystrokes: int = 200000, seed: int = 1) -> Dict[str, float]:
+        """
+        Builds 'count' random snippets and types random text through the
+        automaton: build time, time to add one snippet to the built
+        automaton, and nanoseconds per keystroke on a cold (just edited)
+        and a warm automaton.
+        """
+        rng = random.Random(seed)
+        alphabet = 'abcdefghijklmnopqrstuvwxyz;'
+        abbreviations = {';' + ''.join(rng.choice(alphabet[:-1]) for _ in range(rng.randint(3, 8)))
+                         for _ in range(count)}
+        expander = TextExpander()
+
+        start = time.perf_counter_ns()
+        for abbreviation in abbreviations:
+            expander.add(abbreviation, abbreviation.upper())
+        build_ms = (time.perf_counter_ns() - start) / 1e6
+
+        text = ''.join(rng.choice(alphabet) for _ in range(keystrokes))
+        results = {'snippets': len(expander), 'build_ms': round(build_ms, 1)}
+
+        feed = expander.feed
+        for label in ('cold_ns', 'warm_ns'):
+            start = time.perf_counter_ns()
+            for char in text:
+                feed(char)
+            results[label] = round((time.perf_counter_ns() - start) / keystrokes, 1)
+
+        start = time.perf_counter_ns()
+        expander.add(';zzzzq', 'ZZZZQ')
+        results['add_one_us'] = round((time.perf_counter_ns() - start) / 1e3, 1)
+        return results
@@ -78,6 +78,23 @@ class KeyForgeApp:
         self.app_monitor.set_enforce_focus(config.get("enforce_app_focus", True))
         self.app_monitor.set_target_app(config.get("target_app_name", ""))
         
+        # Timing of chord, tap-hold and sequence rules (config.json only, no UI)
+        if "chord_window_ms" in config:
+            self.key_handler.set_chord_window(config["chord_window_ms"])
+        if "tap_hold_term_ms" in config:
+            self.key_handler.set_tap_hold_term(config["tap_hold_term_ms"])
+        if "sequence_timeout_ms" in config:
+            self.key_handler.set_sequence_timeout(config["sequence_timeout_ms"])
+        if "autofire_rate_hz" in config:
+            self.key_handler.set_autofire_rate(config["autofire_rate_hz"])
+        if "repeat_delay_ms" in config or "repeat_rate_hz" in config:
+            self.key_handler.set_repeat_timing(config.get("repeat_delay_ms", 500),
+                                               config.get("repeat_rate_hz", 30))
+        if config.get("debounce_ms"):
+            self.key_handler.set_debounce(config["debounce_ms"], config.get("debounce_keys") or ())
+        if config.get("snippets"):
+            self.key_handler.set_snippets(config["snippets"])
+        
         # Load rules
         rules_data = config.get("rules", [])
         if rules_data:
@@ -233,7 +250,8 @@ class KeyForgeApp:
         """Adds a rule and refreshes the rules UI."""
         success, error = self.key_handler.add_rule(
             rule_data['key_to_replace'], rule_data['replacement_key'],
-            rule_data['mode'], rule_data['enabled']
+            rule_data['mode'], rule_data['enabled'], rule_data.get('hold_key', ""),
+            rule_data.get('layer', ""), rule_data.get('repeat', "")
         )
         if success: self._refresh_rules_ui()
         else: messagebox.showerror("Error", self.tr_manager.tr(error))
@@ -244,7 +262,8 @@ class KeyForgeApp:
         success, error = self.key_handler.update_rule(
             index,
             rule_data['key_to_replace'], rule_data['replacement_key'],
-            rule_data['mode'], rule_data['enabled']
+            rule_data['mode'], rule_data['enabled'], rule_data.get('hold_key', ""),
+            rule_data.get('layer', ""), rule_data.get('repeat', "")
         )
         if success: self._refresh_rules_ui()
         else: messagebox.showerror("Error", self.tr_manager.tr(error))
@@ -277,6 +296,8 @@ class KeyForgeApp:
         
         config_data = {
             "rules": rules_to_save,
+            # Snippets are edited at runtime (add_snippet / remove_snippet)
+            "snippets": dict(self.key_handler.get_snippets()),
             "enforce_app_focus": enforce_focus,
             "target_app_name": app_name if enforce_focus else ""
         }
@@ -6,6 +6,16 @@ from tkinter import messagebox
 from .components import CommonKeysWindow
 from ..utils import WindowManager, get_icon
 
+# Rule modes, in the order the rule dialog offers them. The lang.json key
+# of each mode is its name (table) and '<name>_mode' (dialog).
+RULE_MODES = ("hold", "toggle", "tap_hold", "layer", "layer_lock", "macro", "autofire", "autofire_toggle",
+              "socd", "socd_neutral")
+# Modes whose "replace with" field names a layer instead of a key
+LAYER_MODES = ("layer", "layer_lock")
+# Auto-repeat policies offered by the rule dialog ("" = the mode's default).
+# The lang.json key of each is 'repeat_<name>'.
+REPEAT_CHOICES = ("", "pass", "drop", "generate")
+
 
 class RulesManagerComponent:
     """Visual manager for remapping rules with a Treeview table"""
@@ -142,13 +152,19 @@ class RulesManagerComponent:
             self.tree.delete(item)
         
         for rule in rules:
-            mode_text = self.tr("hold") if rule.mode == "hold" else self.tr("toggle")
+            mode_text = self.tr(rule.mode) if rule.mode in RULE_MODES else rule.mode
+            source_text = rule.key_to_replace.upper()
+            if rule.layer:
+                source_text = f"[{rule.layer.upper()}] {source_text}"
+            target_text = rule.replacement_key.upper()
+            if rule.hold_key:
+                target_text += f" / {rule.hold_key.upper()}"
             status_icon = self.icon_enabled if rule.enabled else self.icon_disabled
             status_tag = "rule-enabled" if rule.enabled else "rule-disabled"
             
             self.tree.insert("", "end", image=status_icon, values=(
-                rule.key_to_replace.upper(),
-                rule.replacement_key.upper(),
+                source_text,
+                target_text,
                 mode_text
             ), tags=(status_tag,))
     
@@ -302,8 +318,37 @@ class RuleDialog:
         # Mode
         ttk.Label(main_frame, text=self.tr("mode_title"), bootstyle="primary").pack(anchor="w", pady=(0,5))
         self.mode_var = ttk.StringVar(value="hold")
-        ttk.Radiobutton(main_frame, text=self.tr("hold_mode"), variable=self.mode_var, value="hold").pack(anchor="w", pady=2)
-        ttk.Radiobutton(main_frame, text=self.tr("toggle_mode"), variable=self.mode_var, value="toggle").pack(anchor="w", pady=2)
+        for mode in RULE_MODES:
+            ttk.Radiobutton(main_frame, text=self.tr(f"{mode}_mode"), variable=self.mode_var, value=mode).pack(anchor="w", pady=2)
+        
+        # Output while held (tap-hold mode only)
+        hold_frame = ttk.Frame(main_frame)
+        hold_frame.pack(fill="x", pady=(5, 0))
+        ttk.Label(hold_frame, text=self.tr("hold_key_label")).pack(side="left", padx=(0, 5))
+        self.hold_var = ttk.StringVar()
+        self.hold_entry = ttk.Entry(hold_frame, textvariable=self.hold_var)
+        self.hold_entry.pack(side="left", fill="x", expand=True, padx=(0,5))
+        self.btn_detect_hold = ttk.Button(hold_frame, image=search_icon, command=lambda: self._detect_key(self.hold_var), bootstyle="secondary-outline")
+        self.btn_detect_hold.image = search_icon
+        self.btn_detect_hold.pack(side="right")
+        self.mode_var.trace_add("write", lambda *args: self._update_hold_state())
+        self._update_hold_state()
+        
+        # Layer the rule belongs to (empty: base keymap)
+        layer_frame = ttk.Frame(main_frame)
+        layer_frame.pack(fill="x", pady=(10, 0))
+        ttk.Label(layer_frame, text=self.tr("layer_label")).pack(side="left", padx=(0, 5))
+        self.layer_var = ttk.StringVar()
+        ttk.Entry(layer_frame, textvariable=self.layer_var).pack(side="left", fill="x", expand=True)
+        
+        # What the source key's auto-repeat does
+        repeat_frame = ttk.Frame(main_frame)
+        repeat_frame.pack(fill="x", pady=(10, 0))
+        ttk.Label(repeat_frame, text=self.tr("repeat_label")).pack(side="left", padx=(0, 5))
+        self._repeat_names = [self.tr(f"repeat_{choice or 'default'}") for choice in REPEAT_CHOICES]
+        self.repeat_var = ttk.StringVar(value=self._repeat_names[0])
+        ttk.Combobox(repeat_frame, textvariable=self.repeat_var, values=self._repeat_names,
+                     state="readonly").pack(side="left", fill="x", expand=True)
         
         ttk.Separator(main_frame).pack(fill="x", pady=15)
         
@@ -313,6 +358,12 @@ class RuleDialog:
         
         ttk.Button(main_frame, text=self.tr("save_btn"), bootstyle="success", command=self._save).pack(side="right")
 
+    def _update_hold_state(self):
+        """Enables the hold key field only in tap-hold mode."""
+        state = "normal" if self.mode_var.get() == "tap_hold" else "disabled"
+        self.hold_entry.configure(state=state)
+        self.btn_detect_hold.configure(state=state)
+
     def _detect_key(self, var):
         """Captures a pressed key and stores it in the given variable.
         The label is clickable to cancel; it is also removed when the
@@ -353,13 +404,22 @@ class RuleDialog:
         self.source_var.set(self.rule_data.get("key_to_replace", ""))
         self.target_var.set(self.rule_data.get("replacement_key", ""))
         self.mode_var.set(self.rule_data.get("mode", "hold"))
+        self.hold_var.set(self.rule_data.get("hold_key", ""))
+        self.layer_var.set(self.rule_data.get("layer", ""))
+        repeat = self.rule_data.get("repeat", "")
+        if repeat in REPEAT_CHOICES:
+            self.repeat_var.set(self._repeat_names[REPEAT_CHOICES.index(repeat)])
         self.enabled_var.set(self.rule_data.get("enabled", True))
 
     def _save(self):
         """Collects the data and calls the callback, then closes the dialog."""
         source = self.source_var.get().strip().lower()
         target = self.target_var.get().strip().lower()
-        if not source or not target:
+        mode = self.mode_var.get()
+        hold = self.hold_var.get().strip().lower() if mode == "tap_hold" else ""
+        layer = self.layer_var.get().strip().lower()
+        repeat = REPEAT_CHOICES[self._repeat_names.index(self.repeat_var.get())]
+        if not source or not target or (mode == "tap_hold" and not hold):
             # Tell the user why Save did nothing instead of silently ignoring
             messagebox.showwarning(self.tr("warning"), self.tr("fill_fields_error"))
             return
@@ -367,20 +427,31 @@ class RuleDialog:
         # Validate the key names against the keyboard library when possible.
         # If the library cannot validate (tables unavailable, e.g. Linux
         # without a dumpkeys cache), accept the input.
-        for label, name in (("source", source), ("target", target)):
+        fields = [("replace_label", source)]
+        if mode not in LAYER_MODES and mode != "macro":
+            fields.append(("with_label", target))
+        if hold:
+            fields.append(("hold_key_label", hold))
+        for label, name in fields:
             if not self._is_known_key(name):
                 messagebox.showwarning(
                     self.tr("warning"),
-                    self.tr("invalid_key_msg", key=name, field=self.tr("replace_label" if label == "source" else "with_label"))
+                    self.tr("invalid_key_msg", key=name, field=self.tr(label))
                 )
                 return
         
         data = {
             "key_to_replace": source,
             "replacement_key": target,
-            "mode": self.mode_var.get(),
+            "mode": mode,
             "enabled": self.enabled_var.get()
         }
+        if hold:
+            data["hold_key"] = hold
+        if layer:
+            data["layer"] = layer
+        if repeat:
+            data["repeat"] = repeat
         if self.callback: self.callback(data)
         self.dialog.destroy()
 
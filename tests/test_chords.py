@@ -0,0 +1,73 @@
+"""ChordEngine: keys that cannot start a chord are never held back."""
+
+from src.core.chords import ChordEngine
+from src.core.ruleset import SCAN_CODE_SLOTS
+
+J, K, A, X = 36, 37, 30, 45
+
+
+class Event:
+    def __init__(self, event_type, scan_code, time=0.0):
+        self.event_type = event_type
+        self.scan_code = scan_code
+        self.name = str(scan_code)
+        self.time = time
+
+
+class Monitor:
+    target_app_is_active = True
+
+
+class RecordingScheduler:
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay_ns, callback):
+        timer = Timer()
+        self.timers.append(timer)
+        return timer
+
+
+class Timer:
+    cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def engine_with_chord():
+    dispatched, routed, fired = [], [], []
+
+    def dispatch(e):
+        dispatched.append((e.event_type, e.scan_code))
+        return e.scan_code != A  # 'a' is remapped: the original is blocked
+
+    chord_keys = bytearray(SCAN_CODE_SLOTS)
+    chord_keys[J] = chord_keys[K] = 1
+    scheduler = RecordingScheduler()
+    engine = ChordEngine({frozenset((J, K)): fired.append}, chord_keys,
+                         {frozenset((J,)), frozenset((K,))}, dispatch,
+                         lambda scan_code, value: None, routed.append,
+                         Monitor(), scheduler, 30, 'down')
+    return engine, scheduler, dispatched, routed, fired
+
+
+def test_non_chord_keys_are_dispatched_at_once():
+    engine, scheduler, dispatched, routed, fired = engine_with_chord()
+    results = [engine.callback(Event(event_type, code))
+               for code in (A, X) for event_type in ('down', 'up')]
+
+    assert results == [False, False, True, True]
+    assert dispatched == [('down', A), ('up', A), ('down', X), ('up', X)]
+    assert scheduler.timers == [] and routed == [] and fired == []
+
+
+def test_key_typed_after_a_held_chord_key_follows_it():
+    engine, scheduler, dispatched, routed, fired = engine_with_chord()
+
+    assert engine.callback(Event('down', J, 0.0)) is False
+    assert dispatched == [] and routed == [True] and len(scheduler.timers) == 1
+
+    engine.callback(Event('down', X, 0.005))
+    assert dispatched == [('down', J), ('down', X)]
+    assert routed == [True, False] and scheduler.timers[0].cancelled and fired == []
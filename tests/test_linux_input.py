@@ -0,0 +1,187 @@
+"""
+EpollAggregatedDevice with fake event nodes: FIFOs in a temporary
+directory stand in for /dev/input/event*. The ioctls fail on them, so
+every node counts as a keyboard that cannot be grabbed (read anyway).
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+if not sys.platform.startswith('linux'):
+    pytest.skip("evdev is Linux-only", allow_module_level=True)
+
+from src.core import linux_input
+from src.core.linux_input import EVENT_STRUCT, EV_KEY, ChatterFilter, EpollAggregatedDevice
+
+
+class FakeNode:
+    """Stand-in for the library's EventDevice, opened without blocking."""
+
+    def __init__(self, path):
+        self.path = path
+        self._input_file = None
+        self._output_file = None
+
+    @property
+    def input_file(self):
+        if self._input_file is None:
+            self._input_file = os.fdopen(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK), 'rb')
+        return self._input_file
+
+
+class FakeOutput:
+    _output_file = None
+
+
+@pytest.fixture
+def node_dir(tmp_path):
+    writers = {}
+
+    def plug(name):
+        path = str(tmp_path / name)
+        os.mkfifo(path)
+        # Held open for writing, like a device the kernel keeps alive
+        writers[path] = os.open(path, os.O_RDWR)
+        return path
+
+    def unplug(path):
+        os.close(writers.pop(path))
+
+    def press(path, code, value):
+        t = time.time()
+        os.write(writers[path], EVENT_STRUCT.pack(int(t), int(t % 1 * 1e6), EV_KEY, code, value))
+
+    yield tmp_path, plug, unplug, press
+    for fd in writers.values():
+        os.close(fd)
+
+
+def read_until(device, predicate, timeout=1.0):
+    events = []
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        events += device.read_events(0.05)
+    return events
+
+
+def test_hot_plugged_node_is_attached_and_lost(node_dir):
+    directory, plug, unplug, press = node_dir
+    device = EpollAggregatedDevice([], output=FakeOutput(), watch_directory=str(directory),
+                                   open_device=FakeNode)
+    assert len(device.reader) == 0
+
+    path = plug("event3")
+    read_until(device, lambda: len(device.reader) == 1)
+    assert [node.path for node in device.devices] == [path]
+
+    press(path, 30, 1)
+    events = read_until(device, lambda: False, timeout=0.2)
+    assert [(code, value, source) for _, _, _, code, value, source in events] == [(30, 1, path)]
+
+    # The last writer going away hangs the FIFO up, like an unplugged device
+    unplug(path)
+    read_until(device, lambda: len(device.reader) == 0)
+    assert device.devices == []
+
+
+def test_hot_plugged_non_keyboard_is_ignored(node_dir, monkeypatch):
+    directory, plug, _, _ = node_dir
+    monkeypatch.setattr(linux_input, "query_key_capabilities",
+                        lambda fd: bytes(linux_input.KEY_CNT // 8 - 1) + b'\x80')
+    device = EpollAggregatedDevice([], output=FakeOutput(), watch_directory=str(directory),
+                                   open_device=FakeNode)
+    # Only BTN_* and other codes past the keyboard range: not a keyboard
+    plug("event4")
+    read_until(device, lambda: False, timeout=0.2)
+    assert device.devices == [] and len(device.reader) == 0
+
+
+def test_hot_plugged_node_follows_the_active_grabs(node_dir):
+    directory, plug, _, _ = node_dir
+    device = EpollAggregatedDevice([], output=FakeOutput(), watch_directory=str(directory),
+                                   open_device=FakeNode)
+    device.update_grabs([])
+    plug("event5")
+    read_until(device, lambda: len(device.devices) == 1)
+    # Attached, but no active rule wants it: left to the kernel
+    assert len(device.devices) == 1 and len(device.reader) == 0
+    device.update_grabs(None)
+    assert len(device.reader) == 1
+
+
+class FakeUinput:
+    def fileno(self):
+        return -1
+
+
+def test_own_uinput_node_is_never_read(node_dir, monkeypatch):
+    directory, plug, _, press = node_dir
+    own = plug("event7")
+    keyboard = plug("event8")
+    monkeypatch.setattr(linux_input, "uinput_event_nodes", lambda fd: {own})
+    output = FakeOutput()
+    output._output_file = FakeUinput()
+
+    # Listed as a keyboard at startup (e.g. our virtual keyboard after a restart)
+    device = EpollAggregatedDevice([FakeNode(own), FakeNode(keyboard)], output=output,
+                                   watch_directory=str(directory), open_device=FakeNode)
+    assert [node.path for node in device.devices] == [keyboard]
+    assert len(device.reader) == 1
+    # Nor picked up by the hot-plug watch (udev touching its permissions)
+    os.chmod(own, 0o600)
+    assert not device.attach(own)
+
+    press(own, 30, 1)
+    press(keyboard, 48, 1)
+    events = read_until(device, lambda: False, timeout=0.2)
+    assert [(code, source) for _, _, _, code, _, source in events] == [(48, keyboard)]
+
+
+def key(t_us, code, value, device="/dev/input/event3"):
+    return (t_us // 1_000_000, t_us % 1_000_000, EV_KEY, code, value, device)
+
+
+def test_chatter_dropped_both_ways_and_settled():
+    chatter = ChatterFilter([0, 5000] + [0] * 766)
+    # Press bounce, then release bounce; only the first edge of each goes on
+    kept = chatter.filter([key(0, 1, 1), key(1000, 1, 0), key(2000, 1, 1)], 2000)
+    assert [event[4] for event in kept] == [1]
+    kept = chatter.filter([key(100_000, 1, 0), key(101_000, 1, 1), key(102_000, 1, 0)], 102_000)
+    assert [event[4] for event in kept] == [0]
+    assert chatter.dropped == 4 and chatter.next_deadline() is None
+
+    # A tap shorter than the window is not lost: the release settles
+    kept = chatter.filter([key(200_000, 1, 1), key(202_000, 1, 0)], 202_000)
+    assert [event[4] for event in kept] == [1]
+    assert chatter.next_deadline() == 0.207
+    kept = chatter.filter([], 207_000)
+    assert [(event[3], event[4]) for event in kept] == [(1, 0)]
+
+
+def test_debounce_settings_changed_while_a_key_is_unsettled():
+    current = ChatterFilter([0, 5000] + [0] * 766)
+    # The reader holds this filter for its batch...
+    reader_filter = current
+    assert [event[4] for event in reader_filter.filter(
+        [key(0, 1, 1), key(1000, 1, 0)], 1000)] == [1]
+    assert reader_filter.next_deadline() is not None
+
+    # ...while the settings change: a new filter, the old one left alone
+    current = ChatterFilter([0, 20_000] + [0] * 766)
+    kept = reader_filter.filter([], 10_000)
+    assert [(event[3], event[4]) for event in kept] == [(1, 0)]
+
+    # The new filter starts from nothing: no stale state drops a press
+    kept = current.filter([key(12_000, 1, 1)], 12_000)
+    assert [event[4] for event in kept] == [1]
+
+
+def test_reader_benchmark_batches_a_burst_into_one_read():
+    results = linux_input.EvdevReader.benchmark(keys=6, rounds=10)
+    assert results["single_reads_per_key"] == 3.0
+    # 36 events fit the 64-event buffer: one readv for all 12 key events
+    assert results["batched_reads_per_key"] == round(1 / 12, 2)
+    assert results["masked_reads_per_key"] == round(1 / 12, 2)
@@ -0,0 +1,93 @@
+"""MacroPlayer against a scheduler that only fires when told to."""
+
+from src.core.macros import Macro, MacroPlayer
+from src.core.ruleset import OutputAction
+
+
+class PinnedScheduler:
+    """Holds every timer until fire() is called, like a scheduler thread
+    preempted right at the deadline."""
+
+    def __init__(self):
+        self.timers = []
+        self.precise = 0
+
+    def call_at(self, deadline_ns, callback):
+        timer = PinnedTimer(callback)
+        self.timers.append(timer)
+        return timer
+
+    def begin_precise(self):
+        self.precise += 1
+
+    def end_precise(self):
+        self.precise -= 1
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback()
+
+
+class PinnedTimer:
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+B = OutputAction(((48, 1),), ((48, 0),))
+
+
+def player():
+    emitted = []
+    scheduler = PinnedScheduler()
+    return MacroPlayer(emitted.extend, scheduler), scheduler, emitted
+
+
+def test_stop_without_release_drops_a_due_run():
+    # 'generate' repeat: the source key is released right as the repeat
+    # is due, and the rule's handler releases the output itself
+    macros, scheduler, emitted = player()
+    macros.start('repeat', Macro.key_repeat(B, 30), delay_ns=0)
+    macros.stop('repeat', release=False)
+    scheduler.fire()
+    assert emitted == []
+
+
+def test_quick_tap_still_plays_when_stopped_with_release():
+    macros, scheduler, emitted = player()
+    # 'b, 50ms, b': a quick tap plays up to the first delay
+    tap = ((48, 1), (48, 0))
+    macros.start('macro', Macro(((tap, 50_000_000), (tap, 0))), delay_ns=0)
+    macros.stop('macro')
+    scheduler.fire()
+    assert emitted == [(48, 1), (48, 0)]
+
+
+def test_stop_releases_what_the_run_holds():
+    macros, scheduler, emitted = player()
+    macros.start('autofire', Macro.autofire(B, 20))
+    scheduler.fire()
+    assert emitted == [(48, 1)]
+    macros.stop('autofire')
+    assert emitted == [(48, 1), (48, 0)]
+    scheduler.fire()
+    assert emitted == [(48, 1), (48, 0)]
+
+
+def test_autofire_runs_in_precise_mode():
+    # The 1 ms timing target only holds while the scheduler is precise
+    macros, scheduler, _ = player()
+    macros.start('autofire', Macro.autofire(B, 20))
+    assert scheduler.precise == 1
+    scheduler.fire()
+    macros.stop('autofire')
+    assert scheduler.precise == 0
+    macros.toggle('autofire', Macro.autofire(B, 20))
+    assert scheduler.precise == 1
+    macros.toggle('autofire', Macro.autofire(B, 20))
+    assert scheduler.precise == 0